@@ -0,0 +1,260 @@
+import argparse
+import copy
+import itertools
+import json
+import multiprocessing
+import sys
+import time
+import numpy as np
+import MFIS_Classes as classes
+import MFIS_Read_Functions as loader
+
+# Calibration of the trapezoids of the fuzzy sets (InputVarSets.txt and
+# Risks.txt) and of the (consequents_mode, defuzz_mode) configuration against
+# a labeled portfolio: the applications and their known risk, in the format of
+# Results.txt ("appId, Risk, value").
+#
+# Every candidate is a set of trapezoids {setid: [a, b, c, d]}. It is scored
+# by worker processes, each one with the FuzzySystem compiled once: only the
+# rows of the membership tables of the changed sets are evaluated again
+# (engine.CompiledModel.with_trapezoids), and the whole portfolio is scored
+# under every configuration at once with infer_configurations. The loss is
+# the mean squared error, an undefined risk (NaN) counts as the largest
+# possible error.
+#
+#   python MFIS_Calibration.py --outcomes Results.txt --workers 4 \
+#       --output-sets BestInputVarSets.txt --output-risks BestRisks.txt
+
+
+def read_outcomes(filename: str) -> dict:
+    # {appId: risk} of a file of results ("appId, Risk, value" or "appId, value")
+    outcomes = {}
+    with open(filename, 'r') as file:
+        for line in file:
+            fields = [field.strip() for field in line.split(',')]
+            if len(fields) >= 2:
+                outcomes[fields[0]] = float(fields[-1])
+    return outcomes
+
+
+def mean_squared_error(risks: np.ndarray, targets: np.ndarray, penalty: float) -> float:
+    errors = np.square(risks - targets)
+    return float(np.where(np.isnan(errors), penalty, errors).mean())
+
+
+class Calibration:
+
+    def __init__(self, fuzzyRisks: classes.FuzzySetsDict, fuzzyVars: classes.FuzzySetsDict,
+                 rules: classes.RuleList, options, applications: np.ndarray, outcomes: dict,
+                 configurations: list[tuple] = None, setids: list[str] = None, workers: int = 1):
+        # applications: structured array (loader.readApplicationsArray), only
+        # the ones with a known outcome are used
+        # configurations: (consequents_mode, defuzz_mode) pairs compared,
+        # main.CONFIGURATIONS by default
+        # setids: sets whose trapezoids are searched, all of them by default
+        from main import FuzzySystem, CONFIGURATIONS
+        self.fuzzyRisks = fuzzyRisks
+        self.fuzzyVars = fuzzyVars
+        self.setids: list[str] = setids or list(fuzzyRisks) + list(fuzzyVars)
+        self.configurations = configurations or CONFIGURATIONS
+
+        options = dict(options, cache_size=0, metrics=False)
+        fuzzySystem = FuzzySystem(fuzzyRisks, fuzzyVars, rules, options)
+        known = np.array([str(appId) in outcomes for appId in applications['appId']], dtype=bool)
+        if not known.any():
+            raise ValueError("No application with a known outcome")
+        matrix = fuzzySystem.application_matrix(applications[known])
+        targets = np.array([outcomes[str(appId)] for appId in applications['appId'][known]])
+        risk_x = fuzzySystem.compiled.risk_x
+        penalty = float(risk_x[-1] - risk_x[0]) ** 2
+
+        # every worker builds its FuzzySystem from the model compiled here
+        initargs = (fuzzyRisks, fuzzyVars, rules, options, fuzzySystem.compiled, matrix, targets,
+                    self.configurations, penalty)
+        self.pool = None
+        if workers > 1:
+            self.pool = multiprocessing.Pool(workers, _init_worker, initargs)
+        else:
+            _init_worker(*initargs)
+
+        self.evaluations = 0
+        self.best: tuple = (np.inf, {}, None)    # (loss, trapezoids, configuration)
+
+    def evaluate(self, candidates: list[dict]) -> list[tuple]:
+        # (loss, configuration) of every candidate, with its best configuration
+        if self.pool is not None:
+            results = self.pool.map(_evaluate, candidates, chunksize=max(1, len(candidates) // 32))
+        else:
+            results = [_evaluate(candidate) for candidate in candidates]
+        self.evaluations += len(candidates)
+        for candidate, (loss, configuration) in zip(candidates, results):
+            if loss < self.best[0]:
+                self.best = (loss, candidate, configuration)
+        return results
+
+    def trapezoids(self, candidate: dict = None) -> dict:
+        # Every searched set with the trapezoid of candidate, or its current one
+        candidate = candidate or {}
+        fuzzySets = {**self.fuzzyRisks, **self.fuzzyVars}
+        return {setid: list(candidate.get(setid, fuzzySets[setid].trapezoid)) for setid in self.setids}
+
+    def grid_search(self, shifts: dict) -> tuple:
+        # Every combination of the shifts {setid: [offset, ...]} of whole
+        # trapezoids, from the best candidate so far. Returns the best
+        start = self.trapezoids(self.best[1])
+        candidates = []
+        for combination in itertools.product(*shifts.values()):
+            candidate = dict(start)
+            for setid, offset in zip(shifts, combination):
+                candidate[setid] = [value + offset for value in start[setid]]
+            candidates.append(candidate)
+        self.evaluate(candidates)
+        return self.best
+
+    def evolve(self, generations: int = 20, population: int = 32, sigma: float = 0.05,
+               resolution: float = 1, seed: int = 0) -> tuple:
+        # (mu + lambda) evolution strategy from the best candidate so far: the
+        # best quarter of the population are the parents of the next one, every
+        # child changes a few sets by a gaussian noise of sigma times the width
+        # of their universe, rounded to resolution (parameters kept sorted)
+        rng = np.random.default_rng(seed)
+        fuzzySets = {**self.fuzzyRisks, **self.fuzzyVars}
+        widths = {setid: fuzzySets[setid].xmax - fuzzySets[setid].xmin for setid in self.setids}
+        rate = min(1.0, 2 / len(self.setids))
+
+        def mutate(parent: dict) -> dict:
+            child = dict(parent)
+            changed = [setid for setid in self.setids if rng.random() < rate] or [rng.choice(self.setids)]
+            for setid in changed:
+                parameters = np.asarray(parent[setid], dtype=float) + rng.normal(0, sigma * widths[setid], 4)
+                parameters = np.sort(np.round(parameters / resolution) * resolution)
+                child[setid] = [int(value) if resolution == int(resolution) else float(value)
+                                for value in parameters]
+            return child
+
+        parents = [(self.best[0], self.trapezoids(self.best[1]))]
+        for _ in range(generations):
+            children = [mutate(parents[rng.integers(len(parents))][1]) for _ in range(population)]
+            results = self.evaluate(children)
+            ranked = sorted(parents + [(loss, child) for (loss, _), child in zip(results, children)],
+                            key=lambda pair: pair[0])
+            parents = ranked[:max(1, population // 4)]
+        return self.best
+
+    def best_sets(self) -> tuple:
+        # (fuzzyRisks, fuzzyVars) with the trapezoids of the best candidate
+        loss, candidate, configuration = self.best
+        sets = []
+        for fuzzySets in (self.fuzzyRisks, self.fuzzyVars):
+            calibrated = classes.FuzzySetsDict()
+            for setid, fuzzySet in fuzzySets.items():
+                calibrated[setid] = copy.copy(fuzzySet)
+                if setid in candidate:
+                    calibrated[setid].trapezoid = list(candidate[setid])
+            sets.append(calibrated)
+        return tuple(sets)
+
+    def save(self, risksFile: str, varsFile: str) -> None:
+        fuzzyRisks, fuzzyVars = self.best_sets()
+        loader.writeFuzzySetsFile(risksFile, fuzzyRisks)
+        loader.writeFuzzySetsFile(varsFile, fuzzyVars)
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
+# Calibration workers ______________________________________________
+
+_worker: tuple = None
+
+def _init_worker(fuzzyRisks, fuzzyVars, rules, options, compiled, matrix, targets, configurations, penalty) -> None:
+    from main import FuzzySystem
+    global _worker
+    _worker = (FuzzySystem(fuzzyRisks, fuzzyVars, rules, options, compiled), compiled, matrix, targets,
+               configurations, penalty)
+
+def _evaluate(candidate: dict) -> tuple:
+    fuzzySystem, base, matrix, targets, configurations, penalty = _worker
+    # the system scores with the model of the candidate, built from the base one
+    fuzzySystem.use_model(base.with_trapezoids(fuzzySystem.fuzzyRisks, fuzzySystem.fuzzyVars, candidate))
+    risks = fuzzySystem.infer_configurations(matrix, configurations)
+    losses = [(mean_squared_error(risks[name], targets, penalty), name) for name in risks.dtype.names]
+    return min(losses)
+
+
+# Command line ______________________________________________
+
+def parse_list(text: str, type=str) -> list:
+    return [type(item) for item in text.split(',') if item]
+
+
+def main_calibration(arguments: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Calibrates the fuzzy sets and the inference configuration")
+    parser.add_argument("--applications", default="Applications.txt")
+    parser.add_argument("--outcomes", required=True, help="known risks, as in Results.txt")
+    parser.add_argument("--risks", default="Risks.txt")
+    parser.add_argument("--sets", default="InputVarSets.txt")
+    parser.add_argument("--rules", default="Rules.txt")
+    parser.add_argument("--engine", default="sampled", choices=["sampled", "analytic"])
+    parser.add_argument("--membership", default="table", choices=["table", "parametric"])
+    parser.add_argument("--search-sets", default="", help="setids searched, comma separated (default all)")
+    parser.add_argument("--grid-sets", default="", help="setids of the grid search (default the risk sets)")
+    parser.add_argument("--grid-shifts", default="-10,-5,0,5,10", help="offsets of the grid search")
+    parser.add_argument("--generations", type=int, default=20)
+    parser.add_argument("--population", type=int, default=32)
+    parser.add_argument("--sigma", type=float, default=0.05, help="mutation, relative to the universe width")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--output-risks", default="BestRisks.txt")
+    parser.add_argument("--output-sets", default="BestInputVarSets.txt")
+    parser.add_argument("--report", help="JSON file for the best loss and configuration")
+    args = parser.parse_args(arguments)
+
+    fuzzyRisks = loader.readFuzzySetsFile(args.risks)
+    fuzzyVars = loader.readFuzzySetsFile(args.sets)
+    options = {
+        "consequents_mode": "S",
+        "defuzz_mode": "som",
+        "defuzz_engine": args.engine,
+        "membership_mode": args.membership,
+        "debug": {'fuzzySets': False, 'rules': False, 'plot': False, 'rules_applied': False}
+    }
+    start = time.perf_counter()
+    calibration = Calibration(fuzzyRisks, fuzzyVars, loader.readRulesFile(args.rules), options,
+                              loader.readApplicationsArray(args.applications), read_outcomes(args.outcomes),
+                              setids=parse_list(args.search_sets) or None, workers=args.workers)
+    try:
+        calibration.evaluate([{}])
+        print(f"Initial sets: loss {calibration.best[0]:.6g} ({calibration.best[2]})")
+        shifts = parse_list(args.grid_shifts, loader.readNumber)
+        grid = {setid: shifts for setid in parse_list(args.grid_sets) or list(fuzzyRisks)}
+        calibration.grid_search(grid)
+        print(f"Grid search: loss {calibration.best[0]:.6g} ({calibration.best[2]})")
+        calibration.evolve(args.generations, args.population, args.sigma, seed=args.seed)
+        print(f"Evolution: loss {calibration.best[0]:.6g} ({calibration.best[2]})")
+    finally:
+        calibration.close()
+
+    calibration.save(args.output_risks, args.output_sets)
+    loss, candidate, configuration = calibration.best
+    consequents, method = configuration.split('-', 1) if '-' in configuration else (configuration, None)
+    report = {
+        "loss": loss,
+        "consequents_mode": consequents,
+        "defuzz_mode": method,
+        "evaluations": calibration.evaluations,
+        "seconds": time.perf_counter() - start,
+        "trapezoids": calibration.trapezoids(candidate),
+    }
+    print(f"{calibration.evaluations} candidates in {report['seconds']:.2f}s, best sets saved in "
+          f"{args.output_sets} and {args.output_risks}")
+    if args.report:
+        with open(args.report, "w") as file:
+            json.dump(report, file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_calibration())
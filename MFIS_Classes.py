@@ -1,16 +1,226 @@
+import json
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+import MFIS_Engine as engine
+
+# Every container of fuzzy sets or rules counts its changes in version, so that
+# a model compiled from it (and the cache of its results) can tell when it is
+# out of date. A change of a fuzzy set or a rule, or of one of its list
+# attributes in place (rule.antecedent.append(...)), is a change of all the
+# containers it is in; other containers are not affected
+
+class TrackedList(list):
+    # List attribute of a Tracked object, which reports its changes in place
+
+    def __init__(self, values, item, name):
+        list.__init__(self, values)
+        self._item = item
+        self._name = name
+
+    def _changed(self):
+        self._item._changed(self._name)
+
+    def __setitem__(self, index, value):
+        list.__setitem__(self, index, value)
+        self._changed()
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self._changed()
+
+    def __iadd__(self, other):
+        list.__iadd__(self, other)
+        self._changed()
+        return self
+
+    def __imul__(self, n):
+        list.__imul__(self, n)
+        self._changed()
+        return self
+
+    def append(self, value):
+        list.append(self, value)
+        self._changed()
+
+    def extend(self, values):
+        list.extend(self, values)
+        self._changed()
+
+    def insert(self, index, value):
+        list.insert(self, index, value)
+        self._changed()
+
+    def remove(self, value):
+        list.remove(self, value)
+        self._changed()
+
+    def pop(self, *args):
+        value = list.pop(self, *args)
+        self._changed()
+        return value
+
+    def clear(self):
+        list.clear(self)
+        self._changed()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._changed()
+
+    def reverse(self):
+        list.reverse(self)
+        self._changed()
+
+    def __reduce__(self):
+        # copied and pickled as a plain list
+        return (list, (list(self),))
+
+class Tracked:
+    _untracked = ()     # attributes that do not change the model
+    _sequences = ()     # list attributes, also tracked for changes in place
+    _owners = None      # {id: container} of the containers of the object (weak)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_') or name in self._untracked:
+            object.__setattr__(self, name, value)
+            return
+        if name in self._sequences and isinstance(value, (list, tuple)):
+            value = TrackedList(value, self, name)
+        object.__setattr__(self, name, value)
+        self._changed(name)
+
+    def _changed(self, name):
+        if self._owners is not None:
+            for owner in list(self._owners.values()):
+                owner._modified()
+
+    def _adopt(self, owner):
+        if self._owners is None:
+            object.__setattr__(self, '_owners', weakref.WeakValueDictionary())
+        self._owners[id(owner)] = owner
+
+    def __getstate__(self):
+        # without the containers, and the lists as plain ones (copy, pickle)
+        state = dict(self.__dict__)
+        state.pop('_owners', None)
+        for name in self._sequences:
+            if name in state:
+                state[name] = list(state[name])
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            if name in self._sequences:
+                value = TrackedList(value, self, name)
+            object.__setattr__(self, name, value)
+
+def _adopt(container, value):
+    if isinstance(value, Tracked):
+        value._adopt(container)
+
 class FuzzySetsDict(dict):
+    version = 0         # number of changes of the dictionary or of its sets
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
+    def _modified(self):
+        self.version += 1
+
+    def __setitem__(self, key, value):
+        self._modified()
+        _adopt(self, value)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._modified()
+        dict.__delitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        self._modified()
+        dict.update(self, *args, **kwargs)
+        for value in self.values():
+            _adopt(self, value)
+
+    def pop(self, *args):
+        self._modified()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._modified()
+        return dict.popitem(self)
+
+    def setdefault(self, *args):
+        self._modified()
+        value = dict.setdefault(self, *args)
+        _adopt(self, value)
+        return value
+
+    def clear(self):
+        self._modified()
+        dict.clear(self)
     
     def printFuzzySetsDict(self):
         for elem in self:
             print("setid:     ", elem)
             self[elem].printSet()
     
-class FuzzySet:
+class FuzzySet(Tracked):
     var = ""	        # variable of the fuzzy set (ex.: Age)
     label = ""		# label of the specific fuzzy set (ex.: Young)
-    x = []		# list of abscissas, from xmin to xmax, 1 by 1
-    y = []		# list of ordinates (float)
+    xmin = 0            # lower end of the universe
+    xmax = 0            # upper end of the universe
+    step = 1            # resolution of the sampled view x/y
+    trapezoid = []      # parameters [a, b, c, d] of the trapezoidal membership function
     memDegree = 0       # membership degree for the current application
+    _x = None
+    _y = None
+    _untracked = ('memDegree',)
+    _sequences = ('trapezoid',)
+
+    def _changed(self, name):
+        Tracked._changed(self, name)
+        # the sampled view is rebuilt after a change of the parameters
+        if name in ('xmin', 'xmax', 'step'):
+            self._x = None
+            self._y = None
+        elif name == 'trapezoid':
+            self._y = None
+
+    def membership(self, values):
+        # membership degree of values (number or array, int or float)
+        a, b, c, d = self.trapezoid
+        return engine.trapezoid(values, a, b, c, d)
+
+    # Sampled view of the set, only built (and then cached) when it is used,
+    # for plotting and for the sampled inference
+    @property
+    def x(self):
+        # list of abscissas, from xmin to xmax, step by step
+        if self._x is None and self.trapezoid:
+            self._x = engine.universe(self.xmin, self.xmax, self.step)
+        return self._x if self._x is not None else []
+
+    @x.setter
+    def x(self, x):
+        self._x = x
+
+    @property
+    def y(self):
+        # list of ordinates (float)
+        if self._y is None and self.trapezoid:
+            self._y = self.membership(self.x)
+        return self._y if self._y is not None else []
+
+    @y.setter
+    def y(self, y):
+        self._y = y
 
     def printSet(self):
         print("var:       ", self.var)
@@ -21,17 +231,82 @@ class FuzzySet:
         print()
 
 class RuleList(list):
+    version = 0         # number of changes of the list or of its rules
+
+    def __init__(self, rules=()):
+        list.__init__(self)
+        if rules:
+            self.extend(rules)
+
+    def _modified(self):
+        self.version += 1
+
+    def __setitem__(self, index, value):
+        self._modified()
+        if isinstance(index, slice):
+            value = list(value)
+        for rule in (value if isinstance(index, slice) else [value]):
+            _adopt(self, rule)
+        list.__setitem__(self, index, value)
+
+    def __delitem__(self, index):
+        self._modified()
+        list.__delitem__(self, index)
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def append(self, rule):
+        self._modified()
+        _adopt(self, rule)
+        list.append(self, rule)
+
+    def extend(self, rules):
+        self._modified()
+        rules = list(rules)
+        for rule in rules:
+            _adopt(self, rule)
+        list.extend(self, rules)
+
+    def insert(self, index, rule):
+        self._modified()
+        _adopt(self, rule)
+        list.insert(self, index, rule)
+
+    def remove(self, rule):
+        self._modified()
+        list.remove(self, rule)
+
+    def pop(self, *args):
+        self._modified()
+        return list.pop(self, *args)
+
+    def clear(self):
+        self._modified()
+        list.clear(self)
+
+    def sort(self, *args, **kwargs):
+        self._modified()
+        list.sort(self, *args, **kwargs)
+
+    def reverse(self):
+        self._modified()
+        list.reverse(self)
+
     def printRuleList(self):
         for elem in self:
             elem.printRule()
 
-class Rule:
+class Rule(Tracked):
     ruleName = ""	# name of the rule (str)
     antecedent = []	# list of setids		
     consequent = ""	# just one setid
     strength = 0	# float
     consequentX = []	# output fuzzySet, abscissas
     consequentY = []	# output fuzzySet, ordinates
+    _untracked = ('strength', 'consequentX', 'consequentY')
+    _sequences = ('antecedent',)
 
     def printRule(self):
         print("ruleName: ", self.ruleName)
@@ -40,6 +315,211 @@ class Rule:
         print("strength: ", self.strength)
         print()
 
+class InferenceResult:
+    appId = ""          # application identifier (str)
+    risk = 0            # defuzzified risk
+    strengths = []      # strength of every rule, in the order of the RuleList
+    similarities = {}   # max strength of the rules of each consequent {setid: float}
+    aggregation = None  # (x, y) aggregated consequents, None if not computed
+
+    def rulesApplied(self):
+        # indexes of the rules that fired for this application
+        return [i for i, strength in enumerate(self.strengths) if strength]
+
+    def printResult(self):
+        print("App ID:   ", self.appId)
+        print("Risk:     ", self.risk)
+        print("Rules:    ", self.rulesApplied())
+        print()
+
+class ResultCache(OrderedDict):
+    # Bounded LRU cache of results keyed by the input vector and the options of
+    # the FuzzySystem, shared by threads: InferenceResults of inference, and
+    # the risk and a bitmask of the rules fired, packed in bytes, of infer_batch
+
+    def __init__(self, maxsize: int = 10000):
+        super().__init__()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        with self.lock:
+            result = OrderedDict.get(self, key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.move_to_end(key)
+            return result
+
+    def store(self, key, result) -> None:
+        with self.lock:
+            self[key] = result
+            self.move_to_end(key)
+            while len(self) > self.maxsize:
+                self.popitem(last=False)
+                self.evictions += 1
+
+    def lookupMany(self, keys: list) -> list:
+        # lookup of every key, under one acquisition of the lock
+        get, move_to_end = self.get, self.move_to_end
+        with self.lock:
+            results = [get(key) for key in keys]
+            found = 0
+            for key, result in zip(keys, results):
+                if result is not None:
+                    move_to_end(key)
+                    found += 1
+            self.hits += found
+            self.misses += len(keys) - found
+        return results
+
+    def storeMany(self, keys: list, results: list) -> None:
+        with self.lock:
+            for key in keys:
+                if key in self:
+                    self.move_to_end(key)
+            self.update(zip(keys, results))
+            while len(self) > self.maxsize:
+                self.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self), "maxsize": self.maxsize, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+    def printStats(self):
+        for name, value in self.stats().items():
+            print(f"{name + ':':<11}", value)
+        print()
+
+class Metrics:
+    # Opt-in instrumentation of a FuzzySystem (options["metrics"]): number of
+    # calls and wall time of every stage, percentiles over the last `samples`
+    # durations of each stage, applications scored by process and their
+    # throughput. Shared by threads
+
+    def __init__(self, samples: int = 100000):
+        self.samples = samples
+        self.stages = {}        # {stage: [calls, seconds, recent durations (np.ndarray)]}
+        self.applications = 0   # applications written by process/process_arrays
+        self.lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self.lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                entry = self.stages[stage] = [0, 0.0, np.empty(self.samples)]
+            entry[2][entry[0] % self.samples] = seconds
+            entry[0] += 1
+            entry[1] += seconds
+
+    def timed(self, stage: str, function):
+        # function, recording the duration of every call under stage
+        def timedFunction(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        return timedFunction
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def timedIter(self, stage: str, iterable):
+        # iterable, recording the time taken to produce every item
+        start = time.perf_counter()
+        for item in iterable:
+            self.record(stage, time.perf_counter() - start)
+            yield item
+            start = time.perf_counter()
+
+    def drain(self) -> dict:
+        # {stage: (calls, seconds, recent durations)} recorded so far, which
+        # are then cleared (e.g. by a worker process, for merge in its parent)
+        with self.lock:
+            stages = {stage: (calls, seconds, durations[:min(calls, self.samples)].copy())
+                      for stage, (calls, seconds, durations) in self.stages.items()}
+            self.stages = {}
+        return stages
+
+    def merge(self, stages: dict) -> None:
+        # adds the stages of another Metrics (see drain)
+        with self.lock:
+            for stage, (calls, seconds, durations) in stages.items():
+                entry = self.stages.get(stage)
+                if entry is None:
+                    entry = self.stages[stage] = [0, 0.0, np.empty(self.samples)]
+                durations = durations[-self.samples:]
+                # the recent durations are the last ones of the calls added
+                slots = (entry[0] + calls - len(durations) + np.arange(len(durations))) % self.samples
+                entry[2][slots] = durations
+                entry[0] += calls
+                entry[1] += seconds
+
+    def percentiles(self, stage: str, quantiles=(0.5, 0.9, 0.99)) -> dict:
+        with self.lock:
+            calls, _, durations = self.stages[stage]
+            recent = durations[:min(calls, self.samples)].copy()
+        return {q: float(np.quantile(recent, q)) for q in quantiles}
+
+    def report(self, rules: dict = None) -> dict:
+        # rules: {ruleName: applications it fired on}
+        with self.lock:
+            stages = {stage: (calls, seconds) for stage, (calls, seconds, _) in self.stages.items()}
+        processing = stages.get("process", (0, 0.0))[1]
+        return {
+            "stages": {stage: {"calls": calls, "seconds": seconds,
+                               "percentiles": {str(q): value for q, value in self.percentiles(stage).items()}}
+                       for stage, (calls, seconds) in stages.items()},
+            "applications": self.applications,
+            "throughput": self.applications / processing if processing else None,
+            "rules_applied": dict(rules or {}),
+        }
+
+    def toJSON(self, rules: dict = None) -> str:
+        return json.dumps(self.report(rules), indent=2)
+
+    def toPrometheus(self, rules: dict = None) -> str:
+        report = self.report(rules)
+        lines = ["# HELP mfis_stage_seconds Wall time of the stages of the inference",
+                 "# TYPE mfis_stage_seconds summary"]
+        for stage, entry in report["stages"].items():
+            for q, value in entry["percentiles"].items():
+                lines.append(f'mfis_stage_seconds{{stage="{stage}",quantile="{q}"}} {value}')
+            lines.append(f'mfis_stage_seconds_sum{{stage="{stage}"}} {entry["seconds"]}')
+            lines.append(f'mfis_stage_seconds_count{{stage="{stage}"}} {entry["calls"]}')
+        lines += ["# HELP mfis_applications_total Applications scored by process",
+                  "# TYPE mfis_applications_total counter",
+                  f"mfis_applications_total {report['applications']}"]
+        if report["throughput"] is not None:
+            lines += ["# HELP mfis_throughput Applications per second of process",
+                      "# TYPE mfis_throughput gauge",
+                      f"mfis_throughput {report['throughput']}"]
+        lines += ["# HELP mfis_rule_applied_total Applications each rule fired on",
+                  "# TYPE mfis_rule_applied_total counter"]
+        for rule, count in report["rules_applied"].items():
+            lines.append(f'mfis_rule_applied_total{{rule="{rule}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def printMetrics(self, rules: dict = None):
+        for stage, entry in self.report(rules)["stages"].items():
+            print(f"{stage + ':':<26}", entry["calls"], "calls", f"{entry['seconds']:.6f} s")
+        print()
+
 class Application:
     appId = ""          # application identifier (str)
     data = []		# list of ValVarPair
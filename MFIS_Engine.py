@@ -0,0 +1,700 @@
+import copy
+import numpy as np
+
+# Vectorized kernels used by FuzzySystem.infer_batch. Every function works on a
+# whole batch of applications at once (one row per application) and reproduces
+# the same floating point operations as the per-application skfuzzy path.
+
+EPS = np.finfo(float).eps
+
+
+def universe(xmin, xmax, step=1) -> np.ndarray:
+    # Sampled universe of a fuzzy set, xmax excluded
+    return np.arange(xmin, xmax, step)
+
+
+def table_row(fuzzySet, parameters=None) -> np.ndarray:
+    # Membership of a set at the integers of its universe, xmax excluded, as
+    # looked up by the table membership_mode (the step of the set only changes
+    # its sampled view x/y). parameters: [a, b, c, d], its trapezoid by default
+    if fuzzySet.xmin != int(fuzzySet.xmin):
+        raise ValueError(f"{fuzzySet.var}={fuzzySet.label}: the table membership_mode needs an integer xmin")
+    return trapezoid(universe(int(fuzzySet.xmin), fuzzySet.xmax), *(parameters or fuzzySet.trapezoid))
+
+
+def trapezoid(x, a, b, c, d) -> np.ndarray:
+    # Membership of x (any shape) in the trapezoid [a, b, c, d], evaluated
+    # analytically. Same values as skfuzzy.trapmf, also for float inputs
+    x = np.asarray(x, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = np.where(x < b, (x - a) / (b - a), 1.0)
+        y = np.where(x > c, (d - x) / (d - c), y)
+    return np.where((x < a) | (x > d), 0.0, y)
+
+
+class CompiledModel:
+    # Rule base resolved once into integer index arrays (see FuzzySystem.compile)
+    #   variables:   column order of the input matrices
+    #   labels:      setids of the consequents (risk sets)
+    #   setids:      antecedent sets used by the rules, the last row is a
+    #                padding set whose membership is always 1
+    #   set_var:     column of the input matrix read by each antecedent set
+    #   parametric:  True to evaluate the trapezoids on (float) inputs, False
+    #                to look up the sampled tables with integer inputs
+    #   table:       membership of each antecedent set at the integers of its
+    #                universe (whatever the step of its sampled view), padded
+    #                with its last value up to a common width, so that a value
+    #                is looked up with one gather once shifted by set_xmin and
+    #                clamped to [0, width - 1]
+    #   set_xmin:    (table) first integer of the universe of each antecedent set
+    #   set_trapezoids/set_bounds: (parametric) [a, b, c, d] and universe
+    #                [xmin, xmax] of each antecedent set, inputs are clamped
+    #                to the universe before evaluating the trapezoid
+    #   antecedents: rules x K indexes into setids, padded with the ones set
+    #   consequents: index into labels of the consequent of each rule
+    #   risk_x:      universe shared by all the consequent sets
+    #   risk_y:      labels x M membership of each consequent set, stacked
+    #                (resampled onto a common universe only if they differ)
+    #   risk_trapezoids: labels x 4 [a, b, c, d] of each consequent set, used
+    #                by the analytic defuzzification (None if unknown)
+    #   risk_centroids: centroid of each consequent set on the universe, the
+    #                default outputs of the Sugeno consequents
+    #   index:       RuleIndex of the rules that can fire for each input, so
+    #                that only those are evaluated (None: all rules are)
+
+    def __init__(self, fuzzyRisks, fuzzyVars, rules, parametric: bool = False, index: bool = False):
+        self.variables: list[str] = []
+        for setid in fuzzyVars:
+            if fuzzyVars[setid].var not in self.variables:
+                self.variables.append(fuzzyVars[setid].var)
+
+        self.labels: list[str] = list(fuzzyRisks)
+
+        self.setids: list[str] = []
+        for rule in rules:
+            for antecedent in rule.antecedent:
+                if antecedent not in self.setids:
+                    self.setids.append(antecedent)
+        n_sets = len(self.setids)
+
+        self.set_var = np.zeros(n_sets + 1, dtype=np.intp)
+        for i, setid in enumerate(self.setids):
+            self.set_var[i] = self.variables.index(fuzzyVars[setid].var)
+        self.set_rows = np.arange(n_sets + 1)
+
+        self.parametric = parametric
+        if parametric:
+            # The padding set is a trapezoid that is 1 everywhere
+            self.set_trapezoids = np.array(
+                [fuzzyVars[setid].trapezoid for setid in self.setids] + [[-np.inf, -np.inf, np.inf, np.inf]],
+                dtype=float
+            )
+            self.set_bounds = np.array(
+                [[fuzzyVars[setid].xmin, fuzzyVars[setid].xmax] for setid in self.setids] + [[-np.inf, np.inf]],
+                dtype=float
+            )
+        else:
+            rows = [table_row(fuzzyVars[setid]) for setid in self.setids]
+            width = max([len(y) for y in rows] + [1])
+            self.table = np.ones((n_sets + 1, width))
+            for i, y in enumerate(rows):
+                self.table[i, :len(y)] = y
+                self.table[i, len(y):] = y[-1]
+            self.set_xmin = np.array([fuzzyVars[setid].xmin for setid in self.setids] + [0], dtype=np.intp)
+            self.width = width
+
+        k = max([len(rule.antecedent) for rule in rules] + [1])
+        self.antecedents = np.full((len(rules), k), n_sets, dtype=np.intp)
+        self.consequents = np.zeros(len(rules), dtype=np.intp)
+        setindex = {setid: i for i, setid in enumerate(self.setids)}
+        for i, rule in enumerate(rules):
+            self.antecedents[i, :len(rule.antecedent)] = [setindex[a] for a in rule.antecedent]
+            self.consequents[i] = self.labels.index(rule.consequent)
+
+        self.risk_x, self.risk_y = stack_universes(
+            [fuzzyRisks[label].x for label in self.labels],
+            [fuzzyRisks[label].y for label in self.labels]
+        )
+        self.risk_trapezoids = None
+        if all(len(fuzzyRisks[label].trapezoid) == 4 for label in self.labels):
+            self.risk_trapezoids = np.array([fuzzyRisks[label].trapezoid for label in self.labels], dtype=float)
+
+        self.risk_centroids = self._risk_centroids()
+
+        self.index = RuleIndex(self) if index else None
+
+    def _risk_centroids(self) -> np.ndarray:
+        if self.risk_trapezoids is not None:
+            return analytic_defuzz(np.eye(len(self.labels)), self.risk_trapezoids,
+                                   self.risk_x[0], self.risk_x[-1], 'C', 'centroid')
+        return centroid(self.risk_x, self.risk_y)
+
+    def with_trapezoids(self, fuzzyRisks, fuzzyVars, trapezoids: dict) -> "CompiledModel":
+        # Copy of the model where the sets of trapezoids ({setid: [a, b, c, d]},
+        # of risks or of input variables) take those parameters, for the same
+        # universes (those of fuzzyRisks and fuzzyVars). Only their rows of the
+        # tables are evaluated again, the other arrays are shared with this model
+        model = copy.copy(self)
+        sets = [(self.setids.index(setid), parameters) for setid, parameters in trapezoids.items()
+                if setid in self.setids]
+        if sets and self.parametric:
+            model.set_trapezoids = self.set_trapezoids.copy()
+            for i, parameters in sets:
+                model.set_trapezoids[i] = parameters
+        elif sets:
+            model.table = self.table.copy()
+            for i, parameters in sets:
+                y = table_row(fuzzyVars[self.setids[i]], parameters)
+                model.table[i, :len(y)] = y
+                model.table[i, len(y):] = y[-1]
+
+        if any(label in trapezoids for label in self.labels):
+            model.risk_x, model.risk_y = stack_universes(
+                [fuzzyRisks[label].x for label in self.labels],
+                [trapezoid(fuzzyRisks[label].x, *trapezoids[label]) if label in trapezoids else fuzzyRisks[label].y
+                 for label in self.labels]
+            )
+            if self.risk_trapezoids is not None:
+                model.risk_trapezoids = self.risk_trapezoids.copy()
+                for i, label in enumerate(self.labels):
+                    if label in trapezoids:
+                        model.risk_trapezoids[i] = trapezoids[label]
+            model.risk_centroids = model._risk_centroids()
+
+        if sets and self.index is not None:
+            model.index = RuleIndex(model)
+        return model
+
+    def arrays(self) -> dict:
+        # Every array of the model, as saved in a snapshot (FuzzySystem.save_snapshot)
+        arrays = {
+            "variables": np.array(self.variables, dtype=str),
+            "labels": np.array(self.labels, dtype=str),
+            "setids": np.array(self.setids, dtype=str),
+            "set_var": self.set_var,
+            "parametric": np.array(self.parametric),
+            "antecedents": self.antecedents,
+            "consequents": self.consequents,
+            "risk_x": self.risk_x,
+            "risk_y": self.risk_y,
+            "risk_centroids": self.risk_centroids,
+        }
+        if self.parametric:
+            arrays["set_trapezoids"] = self.set_trapezoids
+            arrays["set_bounds"] = self.set_bounds
+        else:
+            arrays["table"] = self.table
+            arrays["set_xmin"] = self.set_xmin
+        if self.risk_trapezoids is not None:
+            arrays["risk_trapezoids"] = self.risk_trapezoids
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, index: bool = False) -> "CompiledModel":
+        # Model saved by arrays(), nothing is recomputed but the RuleIndex
+        model = cls.__new__(cls)
+        model.variables = arrays["variables"].tolist()
+        model.labels = arrays["labels"].tolist()
+        model.setids = arrays["setids"].tolist()
+        model.set_var = arrays["set_var"]
+        model.set_rows = np.arange(len(model.set_var))
+        model.parametric = bool(arrays["parametric"])
+        if model.parametric:
+            model.set_trapezoids = arrays["set_trapezoids"]
+            model.set_bounds = arrays["set_bounds"]
+        else:
+            model.table = arrays["table"]
+            model.set_xmin = arrays["set_xmin"]
+            model.width = model.table.shape[1]
+        model.antecedents = arrays["antecedents"]
+        model.consequents = arrays["consequents"]
+        model.risk_x = arrays["risk_x"]
+        model.risk_y = arrays["risk_y"]
+        model.risk_trapezoids = arrays["risk_trapezoids"] if "risk_trapezoids" in arrays else None
+        model.risk_centroids = arrays["risk_centroids"]
+        model.index = RuleIndex(model) if index else None
+        return model
+
+    def memberships(self, matrix: np.ndarray) -> np.ndarray:
+        # N x (sets + 1) membership degree of every antecedent set
+        if self.parametric:
+            values = np.clip(matrix[:, self.set_var], self.set_bounds[:, 0], self.set_bounds[:, 1])
+            return trapezoid(values, *self.set_trapezoids.T)
+        values = np.clip(matrix[:, self.set_var] - self.set_xmin, 0, self.width - 1)
+        return self.table[self.set_rows, values]
+
+    def strengths(self, matrix: np.ndarray) -> np.ndarray:
+        # N x rules strength of every rule. With the index, the rules that
+        # cannot fire are left at 0 without being evaluated
+        memberships = self.memberships(matrix)
+        if self.index is None:
+            return rule_strengths(memberships, self.antecedents)
+        rows, rules = self.index.candidates(matrix)
+        flat = memberships.ravel()
+        offsets = rows * memberships.shape[1]
+        antecedents = self.antecedents[rules]
+        strengths = flat[offsets + antecedents[:, 0]]
+        for k in range(1, antecedents.shape[1]):
+            np.minimum(strengths, flat[offsets + antecedents[:, k]], out=strengths)
+        output = np.zeros((matrix.shape[0], self.antecedents.shape[0]))
+        output.ravel()[rows * output.shape[1] + rules] = strengths
+        return output
+
+    def sweep_strengths(self, base: np.ndarray, columns: list[int], grids: list[np.ndarray]) -> np.ndarray:
+        # Strength of every rule over the grid of the input row base where the
+        # columns take the values of their grids (len(grid[0]) x ... x rules).
+        # The min of the antecedents on the fixed columns is taken once per
+        # rule, then only the antecedents on each swept column are evaluated
+        # on its own grid, and the grids are combined by broadcasting
+        n_sets = len(self.setids)
+        real = self.antecedents != n_sets
+        swept = real & np.isin(self.set_var[self.antecedents], columns)
+        fixed = np.where(swept, 1.0, self.memberships(base[None, :])[0][self.antecedents]).min(axis=1)
+
+        strengths = fixed
+        for axis, (column, grid) in enumerate(zip(columns, grids)):
+            rows = np.repeat(base[None, :], len(grid), axis=0)
+            rows[:, column] = grid
+            on_column = real & (self.set_var[self.antecedents] == column)
+            rules = np.flatnonzero(on_column.any(axis=1))
+            term = np.ones((len(grid), len(fixed)))
+            term[:, rules] = np.where(on_column[rules], self.memberships(rows)[:, self.antecedents[rules]],
+                                      1.0).min(axis=2)
+            shape = [1] * len(columns) + [len(fixed)]
+            shape[axis] = len(grid)
+            strengths = np.minimum(strengths, term.reshape(shape))
+        return strengths
+
+    def satisfiable(self):
+        # (rules, sets) booleans: the rules nonzero for some input and the
+        # antecedent sets nonzero somewhere (padding set included). Exact over
+        # the inputs memberships() accepts: the cells of RuleIndex, where every
+        # set is either always zero or always nonzero, are checked one by one,
+        # and a rule can fire if it has a nonzero cell on every variable
+        n_sets = len(self.setids)
+        rules = np.ones(self.antecedents.shape[0], dtype=bool)
+        sets = np.ones(n_sets + 1, dtype=bool)
+        for j in range(len(self.variables)):
+            columns = np.flatnonzero(self.set_var[:n_sets] == j)
+            if not columns.size:
+                continue
+            _, support = RuleIndex._support(self, columns)
+            sets[columns] = support.any(axis=0)
+            nonzero = np.ones((len(support), n_sets + 1), dtype=bool)
+            nonzero[:, columns] = support
+            rules &= nonzero[:, self.antecedents].all(axis=2).any(axis=0)
+        return rules, sets
+
+    def similarities(self, strengths: np.ndarray) -> np.ndarray:
+        # N x labels max strength of the rules of every consequent
+        return similarities(strengths, self.consequents, len(self.labels))
+
+
+class RuleIndex:
+    # Rules with nonzero support for every interval of the input variables.
+    # The ends of the supports of the sets of a variable split its axis into
+    # cells (-inf, p0), [p0], (p0, p1), [p1], ... (p: sorted breakpoints) where
+    # every set is either always zero or always nonzero. A rule is a candidate
+    # in a cell if none of its antecedents on that variable is zero there, and
+    # it can only fire if it is a candidate in the cells of all the variables
+    #   n_rules: number of rules
+    #   columns: input columns that rule out some rule somewhere
+    #   points:  breakpoints of each of those columns
+    #   cells:   index into masks of every cell of each column
+    #   masks:   distinct candidate masks (masks x rules) of each column
+
+    def __init__(self, model: CompiledModel):
+        self.n_rules = model.antecedents.shape[0]
+        self.columns: list[int] = []
+        self.points: list[np.ndarray] = []
+        self.cells: list[np.ndarray] = []
+        self.masks: list[np.ndarray] = []
+        n_sets = len(model.setids)
+        for j in range(len(model.variables)):
+            sets = np.flatnonzero(model.set_var[:n_sets] == j)
+            if not sets.size:
+                continue
+            points, support = self._support(model, sets)
+            nonzero = np.ones((len(support), n_sets + 1), dtype=bool)
+            nonzero[:, sets] = support
+            masks, cells = np.unique(nonzero[:, model.antecedents].all(axis=2), axis=0, return_inverse=True)
+            if len(masks) > 1:
+                self.columns.append(j)
+                self.points.append(points)
+                self.cells.append(cells.reshape(-1))
+                self.masks.append(masks)
+
+    @staticmethod
+    def _support(model: CompiledModel, sets: np.ndarray):
+        # breakpoints of the sets of one variable and cells x sets nonzero membership
+        if model.parametric:
+            points = np.concatenate([model.set_trapezoids[sets].ravel(), model.set_bounds[sets].ravel()])
+        else:
+            xmin = model.set_xmin[sets]
+            points = np.arange(xmin.min(), xmin.max() + model.width, dtype=float)
+        points = np.unique(points[np.isfinite(points)])
+
+        # one value inside every cell
+        inside = np.empty(2 * len(points) + 1)
+        inside[1::2] = points
+        inside[2:-1:2] = points[:-1] + (points[1:] - points[:-1]) / 2
+        inside[0] = np.nextafter(points[0], -np.inf) if len(points) else 0.0
+        inside[-1] = np.nextafter(points[-1], np.inf) if len(points) else 0.0
+
+        if model.parametric:
+            # same clamping as memberships(), then a < x < d or b <= x <= c
+            x = np.clip(inside[:, None], model.set_bounds[sets, 0], model.set_bounds[sets, 1])
+            a, b, c, d = model.set_trapezoids[sets].T
+            return points, ((a < x) & (x < d)) | ((b <= x) & (x <= c))
+        values = np.clip(np.floor(inside)[:, None] - xmin, 0, model.width - 1).astype(np.intp)
+        return points, model.table[sets, values] > 0
+
+    def cell(self, i: int, values: np.ndarray) -> np.ndarray:
+        # cell of the values of the i-th indexed column
+        points = self.points[i]
+        position = np.searchsorted(points, values)
+        exact = points[np.minimum(position, len(points) - 1)] == values
+        return 2 * position + exact
+
+    def candidates(self, matrix: np.ndarray):
+        # (row, rule) pairs of the rules that can fire for each row of matrix,
+        # sorted by row. The candidate rules are found once per distinct
+        # combination of cells
+        n = matrix.shape[0]
+        if not self.columns:
+            return np.repeat(np.arange(n), self.n_rules), np.tile(np.arange(self.n_rules), n)
+
+        masks = np.column_stack([self.cells[i][self.cell(i, matrix[:, j])] for i, j in enumerate(self.columns)])
+        combinations, inverse = np.unique(masks, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        candidate = self.masks[0][combinations[:, 0]]
+        for i in range(1, len(self.columns)):
+            candidate &= self.masks[i][combinations[:, i]]
+
+        index = np.flatnonzero(candidate[inverse])
+        return index // self.n_rules, index % self.n_rules
+
+
+def unique_rows(matrix: np.ndarray) -> tuple:
+    # Distinct rows of matrix (sorted) and the index of every row among them,
+    # as np.unique(matrix, axis=0, return_inverse=True). Integer rows are
+    # packed into one integer code first, much faster to sort than the rows
+    if matrix.dtype.kind in 'iu' and matrix.size:
+        low = matrix.min(axis=0)
+        spans = matrix.max(axis=0).astype(float) - low + 1
+        if np.prod(spans) < 2 ** 62:
+            codes = np.zeros(len(matrix), dtype=np.int64)
+            for column, span in zip((matrix - low).T, spans.astype(np.int64)):
+                codes *= span
+                codes += column
+            _, first, inverse = np.unique(codes, return_index=True, return_inverse=True)
+            return matrix[first], inverse
+    rows, inverse = np.unique(matrix, axis=0, return_inverse=True)
+    return rows, inverse.reshape(-1)
+
+
+def stack_universes(xs: list, ys: list):
+    # Stacks the membership functions ys (labels x M) on a single universe.
+    # If the universes xs differ, every set is resampled once onto a universe
+    # covering all of them with the smallest step, as skfuzzy.fuzzy_or would
+    x = np.asarray(xs[0])
+    if all(np.array_equal(x, other) for other in xs[1:]):
+        return x, np.array(ys, dtype=float)
+
+    minstep = min(np.diff(other).min() for other in xs)
+    mi = min(np.min(other) for other in xs)
+    ma = max(np.max(other) for other in xs)
+    x = np.r_[mi:ma + minstep:minstep]
+    if x.max() > (ma + minstep / 2):
+        x = x[:-1]
+
+    stacked = np.empty((len(ys), len(x)))
+    for i in range(len(ys)):
+        order = np.argsort(xs[i])
+        stacked[i] = np.interp(x, np.asarray(xs[i])[order], np.asarray(ys[i], dtype=float)[order])
+    return x, stacked
+
+
+def rule_strengths(memberships: np.ndarray, antecedents: np.ndarray) -> np.ndarray:
+    # memberships: N x (sets + 1) membership degrees, last column is all ones
+    # antecedents: rules x K indexes into memberships, padded with the ones column
+    # returns N x rules, min of the antecedents of every rule
+    return memberships[:, antecedents].min(axis=2)
+
+
+def similarities(strengths: np.ndarray, consequents: np.ndarray, n_labels: int) -> np.ndarray:
+    # max strength of the rules of every consequent label (0 if none of them fired)
+    output = np.zeros((strengths.shape[0], n_labels))
+    for label in range(n_labels):
+        column = strengths[:, consequents == label]
+        if column.shape[1]:
+            output[:, label] = column.max(axis=1)
+    return output
+
+
+def clip(similarity: np.ndarray, y: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    # similarity: N x labels, y: labels x M -> N x labels x M, written into out if given
+    return np.minimum(similarity[:, :, None], y[None, :, :], out=out)
+
+
+def scale(similarity: np.ndarray, y: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    return np.multiply(similarity[:, :, None], y[None, :, :], out=out)
+
+
+def consequents(similarity: np.ndarray, y: np.ndarray, method: str, out: np.ndarray = None) -> np.ndarray:
+    # Clip ('C') or scale ('S') the stacked consequent sets, any other method
+    # leaves them unchanged
+    if out is None:
+        out = np.empty((similarity.shape[0],) + y.shape)
+    if method == 'C':
+        return clip(similarity, y, out)
+    elif method == 'S':
+        return scale(similarity, y, out)
+    out[...] = y
+    return out
+
+
+def aggregation(consequents: np.ndarray) -> np.ndarray:
+    # Union (max) of the ... x labels x M consequents over the labels axis
+    return consequents.max(axis=-2)
+
+
+def sugeno(strengths: np.ndarray, consequents: np.ndarray, outputs: np.ndarray) -> np.ndarray:
+    # strengths: N x rules, consequents: label of every rule,
+    # outputs: value of every label (labels, or N x labels for linear consequents)
+    # returns the N strength-weighted averages of the rule outputs (NaN if no
+    # rule fired)
+    total = strengths.sum(axis=1)
+    weighted = (strengths * outputs[..., consequents]).sum(axis=1)
+    return np.divide(weighted, total, out=np.full(total.shape, np.nan), where=total > 0)
+
+
+def centroid(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    # Same piecewise linear centroid as skfuzzy.defuzzify.centroid, for every row
+    x = np.asarray(x)
+    if len(x) == 1:
+        return x[0] * y[:, 0] / np.fmax(y[:, 0], EPS).astype(float)
+
+    x1, x2 = x[:-1], x[1:]
+    y1, y2 = y[:, :-1], y[:, 1:]
+    dx = x2 - x1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        moment = np.select(
+            [y1 == y2, (y1 == 0.0) & (y2 != 0.0), (y2 == 0.0) & (y1 != 0.0)],
+            [
+                np.broadcast_to(0.5 * (x1 + x2), y1.shape),
+                np.broadcast_to(2.0 / 3.0 * dx + x1, y1.shape),
+                np.broadcast_to(1.0 / 3.0 * dx + x1, y1.shape),
+            ],
+            (2.0 / 3.0 * dx * (y2 + 0.5 * y1)) / (y1 + y2) + x1
+        )
+        area = np.select(
+            [y1 == y2, (y1 == 0.0) & (y2 != 0.0), (y2 == 0.0) & (y1 != 0.0)],
+            [dx * y1, 0.5 * dx * y2, 0.5 * dx * y1],
+            0.5 * dx * (y1 + y2)
+        )
+    skip = ((y1 == 0.0) & (y2 == 0.0)) | (x1 == x2)
+    moment_area = np.where(skip, 0.0, moment * area)
+    area = np.where(skip, 0.0, area)
+
+    # cumsum adds left to right, like the python loop of skfuzzy
+    sum_moment_area = np.cumsum(moment_area, axis=1)[:, -1]
+    sum_area = np.cumsum(area, axis=1)[:, -1]
+    return sum_moment_area / np.fmax(sum_area, EPS).astype(float)
+
+
+def bisector(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    # Same piecewise linear bisector as skfuzzy.defuzzify.bisector, for every row
+    x = np.asarray(x)
+    n = y.shape[0]
+    if len(x) == 1:
+        return np.full(n, x[0], dtype=float)
+
+    x1, x2 = x[:-1], x[1:]
+    y1, y2 = y[:, :-1], y[:, 1:]
+    dx = x2 - x1
+    area = np.select(
+        [y1 == y2, (y1 == 0.0) & (y2 != 0.0), (y2 == 0.0) & (y1 != 0.0)],
+        [dx * y1, 0.5 * dx * y2, 0.5 * dx * y1],
+        0.5 * dx * (y1 + y2)
+    )
+    skip = ((y1 == 0.0) & (y2 == 0.0)) | (x1 == x2)
+    area = np.where(skip, 0.0, area)
+    accum_area = np.cumsum(area, axis=1)
+    sum_area = accum_area[:, -1]
+    # skfuzzy leaves the accumulated area of skipped segments at 0
+    accum_area = np.where(skip, 0.0, accum_area)
+
+    rows = np.arange(n)
+    index = np.argmax(accum_area >= (sum_area / 2.)[:, None], axis=1)
+    subarea = np.where(index == 0, 0.0, accum_area[rows, np.maximum(index - 1, 0)])
+    subarea = sum_area / 2. - subarea
+
+    x1 = x[index]
+    x2 = x[index + 1]
+    y1 = y[rows, index]
+    y2 = y[rows, index + 1]
+    x2minusx1 = x2 - x1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m = (y2 - y1) / x2minusx1
+        u = np.select(
+            [y1 == y2, (y1 == 0.0) & (y2 != 0.0), (y2 == 0.0) & (y1 != 0.0)],
+            [
+                subarea / y1 + x1,
+                x1 + np.sqrt(2. * subarea * x2minusx1 / y2),
+                x2 - np.sqrt(x2minusx1 * x2minusx1 - (2. * subarea * x2minusx1 / y1)),
+            ],
+            x1 - (y1 - np.sqrt(y1 * y1 + 2.0 * m * subarea)) / m
+        )
+    return u
+
+
+def maximum(x: np.ndarray, y: np.ndarray, method: str) -> np.ndarray:
+    # mean, smallest and largest of maximum of every row (x is sorted, som and
+    # lom are points of x and keep its dtype, as with skfuzzy)
+    x = np.asarray(x)
+    is_max = y == y.max(axis=1, keepdims=True)
+    if method == 'mom':
+        return (is_max * x).sum(axis=1) / is_max.sum(axis=1)
+    elif method == 'som':
+        return x[np.argmax(is_max, axis=1)]
+    elif method == 'lom':
+        return x[len(x) - 1 - np.argmax(is_max[:, ::-1], axis=1)]
+    raise ValueError(f"The input for `mode`, {method}, was incorrect.")
+
+
+def defuzz(x: np.ndarray, y: np.ndarray, method: str) -> np.ndarray:
+    # Rows without area have no centroid/bisector: they are returned as NaN
+    # (skfuzzy raises EmptyMembershipError for them)
+    if method in ('centroid', 'bisector'):
+        output = np.full(y.shape[0], np.nan)
+        valid = y.sum(axis=1) != 0
+        if valid.any():
+            kernel = centroid if method == 'centroid' else bisector
+            output[valid] = kernel(x, y[valid])
+        return output
+    return maximum(x, y, method)
+
+
+# Analytic defuzzification ___________________________________
+# The consequents are trapezoids clipped or scaled by their rule strength, so
+# the aggregation is piecewise linear with its corners at the trapezoid
+# breakpoints and at the crossings between the edges of two sets. Evaluating
+# it only there gives the exact centroid/bisector/maximums without sampling a
+# grid: the cost depends on the number of output sets, not on the universe.
+
+def trapezoid_aggregation(similarity: np.ndarray, trapezoids: np.ndarray, lo: float, hi: float, method: str):
+    # Exact aggregation of the clipped ('C') or scaled ('S') trapezoids
+    # returns (x, y), N x K sorted corners in [lo, hi] and the membership there
+    n, labels = similarity.shape
+    a, b, c, d = [trapezoids[None, :, i] for i in range(4)]
+    h = similarity if method in ('C', 'S') else np.ones_like(similarity)
+
+    # Inverse slopes of the edges, vertical edges get a huge slope so that
+    # they jump between a and the next float after it (d and the one before)
+    with np.errstate(divide='ignore'):
+        rise = np.where(b > a, 1 / (b - a), 1e300)
+        fall = np.where(d > c, 1 / (d - c), 1e300)
+
+    # Edges of every set as lines y = m x + k: rise, plateau, fall
+    top = h if method == 'S' else np.ones_like(h)
+    m = np.concatenate([top * rise, np.zeros_like(h), -top * fall], axis=1)
+    k = np.concatenate([-top * rise * a, h, top * fall * d], axis=1)
+    # Corners between the edges of two different sets (the rest are breakpoints)
+    line_set = np.tile(np.arange(labels), 3)
+    line_kind = np.repeat(np.arange(3), labels)
+    i, j = np.triu_indices(3 * labels, 1)
+    keep = (line_set[i] != line_set[j]) & ~((line_kind[i] == 1) & (line_kind[j] == 1))
+    i, j = i[keep], j[keep]
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        crossings = (k[:, j] - k[:, i]) / (m[:, i] - m[:, j])
+
+    if method == 'C':
+        b = a + h * (b - a)
+        c = d - h * (d - c)
+    x = np.concatenate([
+        np.broadcast_to([[lo, hi]], (n, 2)),
+        np.broadcast_to(a, h.shape), np.broadcast_to(np.nextafter(a, np.inf), h.shape),
+        np.broadcast_to(b, h.shape), np.broadcast_to(c, h.shape),
+        np.broadcast_to(np.nextafter(d, -np.inf), h.shape), np.broadcast_to(d, h.shape),
+        crossings
+    ], axis=1)
+    x = np.sort(np.clip(np.where(np.isfinite(x), x, lo), lo, hi), axis=1)
+
+    xs = x[:, None, :]
+    with np.errstate(over='ignore', invalid='ignore'):
+        mu = np.minimum((xs - a[:, :, None]) * rise[:, :, None], (d[:, :, None] - xs) * fall[:, :, None])
+    np.clip(mu, 0.0, 1.0, out=mu)
+    if method == 'C':
+        np.minimum(mu, h[:, :, None], out=mu)
+    else:
+        np.multiply(mu, h[:, :, None], out=mu)
+    return x, mu.max(axis=1)
+
+
+def analytic_centroid(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    dx = np.diff(x, axis=1)
+    x1, x2 = x[:, :-1], x[:, 1:]
+    y1, y2 = y[:, :-1], y[:, 1:]
+    area = 0.5 * dx * (y1 + y2)
+    moment = dx * (x1 * (2 * y1 + y2) + x2 * (y1 + 2 * y2)) / 6
+    total = area.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(total > 0, moment.sum(axis=1) / total, np.nan)
+
+
+def analytic_bisector(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    dx = np.diff(x, axis=1)
+    area = 0.5 * dx * (y[:, :-1] + y[:, 1:])
+    accum = np.cumsum(area, axis=1)
+    half = accum[:, -1] / 2
+
+    rows = np.arange(x.shape[0])
+    index = np.argmax(accum >= half[:, None], axis=1)
+    remainder = half - np.where(index == 0, 0.0, accum[rows, np.maximum(index - 1, 0)])
+    x1, y1 = x[rows, index], y[rows, index]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (y[rows, index + 1] - y1) / dx[rows, index]
+        # root of y1 s + slope s^2 / 2 = remainder, stable when slope is 0
+        s = 2 * remainder / (y1 + np.sqrt(y1 * y1 + 2 * slope * remainder))
+    return np.where(half > 0, x1 + s, np.nan)
+
+
+def analytic_maximum(x: np.ndarray, y: np.ndarray, method: str) -> np.ndarray:
+    ymax = y.max(axis=1, keepdims=True)
+    is_max = y >= ymax - 1e-10
+    if method == 'som':
+        return np.where(is_max, x, np.inf).min(axis=1)
+    elif method == 'lom':
+        return np.where(is_max, x, -np.inf).max(axis=1)
+    elif method == 'mom':
+        # mean over the plateaus at the maximum, or over isolated peaks
+        plateau = is_max[:, :-1] & is_max[:, 1:]
+        length = np.where(plateau, np.diff(x, axis=1), 0.0)
+        middle = (x[:, :-1] + x[:, 1:]) / 2
+        total = length.sum(axis=1)
+        peaks = is_max & np.concatenate([np.ones((x.shape[0], 1), bool), np.diff(x, axis=1) > 0], axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(
+                total > 0,
+                (middle * length).sum(axis=1) / total,
+                (peaks * x).sum(axis=1) / peaks.sum(axis=1)
+            )
+    raise ValueError(f"The input for `mode`, {method}, was incorrect.")
+
+
+def analytic_defuzz(similarity: np.ndarray, trapezoids: np.ndarray, lo: float, hi: float,
+                    consequents_method: str, method: str) -> np.ndarray:
+    # Defuzzified value of N rows of similarities (N x labels), computed on the
+    # exact trapezoids instead of their sampled grid
+    x, y = trapezoid_aggregation(similarity, trapezoids, lo, hi, consequents_method)
+    return analytic_defuzz_points(x, y, method)
+
+
+def analytic_defuzz_points(x: np.ndarray, y: np.ndarray, method: str) -> np.ndarray:
+    # Defuzzified value of an aggregation given by trapezoid_aggregation
+    if method == 'centroid':
+        return analytic_centroid(x, y)
+    elif method == 'bisector':
+        return analytic_bisector(x, y)
+    return analytic_maximum(x, y, method)
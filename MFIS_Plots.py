@@ -0,0 +1,146 @@
+import multiprocessing
+import os
+from collections import deque
+import numpy as np
+
+# Headless export of the figures of a FuzzySystem to PNG/SVG files with the
+# Agg backend. The figures are drawn by a pool of worker processes from arrays
+# already computed by the scoring (the aggregation of an application and its
+# defuzzified risk), so scoring never waits for matplotlib: at most 2 figures
+# per worker are pending, and every worker draws all its figures on the same
+# Figure object, cleared between them, so memory stays flat.
+#
+# The draw_* functions are also used by the interactive plots of main.py
+
+LINE_COLORS = ['g', 'y', 'r', 'k']
+
+# Variables of the fuzzy sets figure, the last one drawn apart on the right
+VARS = ['Age', 'IncomeLevel', 'Assets', 'Amount', 'Job', 'History', 'Risk']
+PLOT_ROWS = 2
+PLOT_COLS = 4
+
+
+def draw_aggregation(fig, appId: str, riskSets: list[tuple], x, y, risk: float, method: str) -> None:
+    # riskSets: (label, x, y) of every risk set
+    ax = fig.subplots()
+    fig.suptitle(f"Inference of application {appId}")
+    fig.subplots_adjust(left=0.1, right=0.95, bottom=0.1, top=0.9, wspace=0.4, hspace=0.3)
+
+    # Plot fuzzy risk set
+    labels = []
+    for i, (label, setX, setY) in enumerate(riskSets):
+        ax.plot(setX, setY, f':{LINE_COLORS[i % len(LINE_COLORS)]}', label=label, linewidth=1)
+        labels.append(label)
+
+    # Plot aggregation
+    ax.plot(x, y, '-b', label='Aggregation')
+    labels.append('Aggregation')
+
+    # Plot defuzz value
+    ax.plot([risk, risk], [0, 1], 'r', label='Defuzzification', linewidth=1, linestyle='--')
+    labels.append(method)
+    ax.set_xlabel("Risk")
+    ax.set_ylabel("Membership degree")
+    ax.legend(labels, loc='lower right', fontsize='xx-small')
+
+
+def draw_fuzzysets(fig, fuzzySets: list[tuple]) -> None:
+    # fuzzySets: (var, label, x, y) of every fuzzy set, risks included
+    axis = fig.subplots(PLOT_ROWS, PLOT_COLS)
+    fig.subplots_adjust(left=0.1, right=0.95, bottom=0.1, top=0.9, wspace=0.4, hspace=0.3)
+    fig.suptitle("Fuzzy Sets", fontsize=16)
+
+    # Create special axis for Risk
+    gs = axis[0, -1].get_gridspec()
+    for ax in axis[0:, -1]:
+        ax.remove()
+    axRisk = fig.add_subplot(gs[0:, -1])
+
+    counts = [0] * len(VARS)
+    labels = [[] for _ in range(len(VARS))]
+    for var, label, x, y in fuzzySets:
+        i = VARS.index(var)
+        ax = axRisk if i == 6 else axis[i % PLOT_ROWS][i // PLOT_ROWS]
+        ax.plot(x, y, f"-{LINE_COLORS[counts[i] % len(LINE_COLORS)]}", label=label)
+        labels[i].append(label)
+        counts[i] += 1
+
+    for i in range(0, 6):
+        ax = axis[i % PLOT_ROWS][i // PLOT_ROWS]
+        ax.set_xlabel(VARS[i])
+        ax.set_ylabel("Membership degree")
+        ax.legend(labels[i], loc='lower right', fontsize='xx-small')
+    axRisk.set_xlabel(VARS[6])
+    axRisk.set_ylabel("Membership degree")
+    axRisk.legend(labels[6], loc='lower right', fontsize='xx-small')
+
+
+class PlotExporter:
+    # Writes figures to directory/<name>.<format> ('png' or 'svg') from a pool
+    # of worker processes. Use it as a context manager, or close() it to wait
+    # for the figures still pending
+
+    def __init__(self, directory: str, riskSets: list[tuple], method: str, format: str = 'png',
+                 workers: int = 2, dpi: int = 100):
+        # riskSets: (label, x, y) of every risk set, sent once to every worker
+        # method: defuzzification method shown in the legends
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.format = format.lower()
+        self.workers = workers
+        self.files: list[str] = []
+        self.pool = multiprocessing.Pool(workers, _init_worker, (riskSets, method, dpi))
+        self.pending = deque()
+
+    def aggregation(self, appId: str, x: np.ndarray, y: np.ndarray, risk: float) -> None:
+        self._submit(f"aggregation_{appId}", ("aggregation", appId, x, y, risk))
+
+    def fuzzysets(self, fuzzySets: list[tuple]) -> None:
+        self._submit("fuzzysets", ("fuzzysets", fuzzySets))
+
+    def _submit(self, name: str, figure: tuple) -> None:
+        filename = os.path.join(self.directory, f"{name}.{self.format}")
+        self.pending.append(self.pool.apply_async(_render, (filename, figure)))
+        self.files.append(filename)
+        while len(self.pending) > 2 * self.workers:
+            self.pending.popleft().get()
+
+    def close(self) -> None:
+        while self.pending:
+            self.pending.popleft().get()
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Plot workers ______________________________________________
+
+_worker_figure = None
+_worker_options: tuple = None
+
+def _init_worker(riskSets: list[tuple], method: str, dpi: int) -> None:
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+    global _worker_figure, _worker_options
+    # A bare Figure (no pyplot) is never registered, the same one is reused
+    _worker_figure = Figure()
+    _worker_options = (riskSets, method, dpi)
+
+def _render(filename: str, figure: tuple) -> None:
+    riskSets, method, dpi = _worker_options
+    fig = _worker_figure
+    fig.clear()
+    if figure[0] == "aggregation":
+        _, appId, x, y, risk = figure
+        fig.set_size_inches(6.4, 4.8)
+        draw_aggregation(fig, appId, riskSets, x, y, risk, method)
+    else:
+        fig.set_size_inches(12, 5)
+        draw_fuzzysets(fig, figure[1])
+    fig.savefig(filename, dpi=dpi)
@@ -1,12 +1,25 @@
+import hashlib
+import os
+import struct
 import numpy as np
-import skfuzzy as skf
-import matplotlib.pyplot as plt
+from itertools import islice
 from MFIS_Classes import *
 
-def readFuzzySetsFile(fleName):
+def readNumber(text):
+    # int if possible (keeps integer universes as before), float otherwise
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+def readFuzzySetsFile(fleName, step=1):
     """
     This function reads a file containing fuzzy set descriptions
-    and returns a dictionary with all of them
+    and returns a dictionary with all of them. Only the trapezoid
+    parameters are kept: the x/y arrays (sampled every step) are
+    built the first time they are used. The step only changes that
+    sampled view, the table membership_mode reads the integers of
+    the universe
     """
     fuzzySetsDict = FuzzySetsDict() # dictionary to be returned
     inputFile = open(fleName, 'r')
@@ -19,22 +32,37 @@ def readFuzzySetsFile(fleName):
         fuzzySet.var=var_label[0]
         fuzzySet.label=var_label[1]        
 
-        xmin = int(elementsList[1])
-        xmax = int(elementsList[2])
-        a = int(elementsList[3])
-        b = int(elementsList[4])
-        c = int(elementsList[5])
-        d = int(elementsList[6])
-        x = np.arange(xmin,xmax,1)
-        y = skf.trapmf(x, [a, b, c, d])
-        fuzzySet.x = x
-        fuzzySet.y = y
+        fuzzySet.xmin = readNumber(elementsList[1])
+        fuzzySet.xmax = readNumber(elementsList[2])
+        a = readNumber(elementsList[3])
+        b = readNumber(elementsList[4])
+        c = readNumber(elementsList[5])
+        d = readNumber(elementsList[6])
+        fuzzySet.trapezoid = [a, b, c, d]
+        fuzzySet.step = step
         fuzzySetsDict.update( { setid : fuzzySet } )
 
         line = inputFile.readline()
     inputFile.close()
     return fuzzySetsDict
 
+def writeFuzzySetsFile(filename, fuzzySetsDict):
+    # Same format as readFuzzySetsFile: setid, xmin, xmax, a, b, c, d
+    with open(filename, 'w') as outputFile:
+        for setid, fuzzySet in fuzzySetsDict.items():
+            values = [fuzzySet.xmin, fuzzySet.xmax] + list(fuzzySet.trapezoid)
+            outputFile.write(', '.join([setid] + [str(value) for value in values]) + '\n')
+
+def sourceHash(filenames):
+    # sha256 of the contents of the files, in order
+    digest = hashlib.sha256()
+    for filename in filenames:
+        with open(filename, 'rb') as inputFile:
+            content = inputFile.read()
+        digest.update(len(content).to_bytes(8, 'little'))
+        digest.update(content)
+    return digest.hexdigest()
+
 def readRulesFile(filename):
     inputFile = open(filename, 'r')
     rules = RuleList()
@@ -54,19 +82,299 @@ def readRulesFile(filename):
     inputFile.close()
     return rules
 
+def writeRulesFile(filename, rules):
+    # Same format as readRulesFile: ruleName, consequent, antecedents...
+    with open(filename, 'w') as outputFile:
+        for rule in rules:
+            outputFile.write(', '.join([rule.ruleName, rule.consequent] + list(rule.antecedent)) + '\n')
+
+def readApplication(line):
+    elementsList = line.split(', ')
+    app = Application()
+    app.appId = elementsList[0]
+    app.data = []
+    for i in range(1, len(elementsList), 2):
+        app.data.append([elementsList[i], readNumber(elementsList[i+1])])
+    return app
+
+def iterApplicationsFile(filename):
+    """
+    Generator version of readApplicationsFile: the applications are
+    yielded one by one while the file is read, so memory does not
+    grow with the size of the file
+    """
+    with open(filename, 'r') as inputFile:
+        for line in inputFile:
+            if line.strip():
+                yield readApplication(line)
+
 def readApplicationsFile(filename):
-    inputFile = open(filename, 'r')
-    applicationList = []
-    line = inputFile.readline()
-    while line != '':
-        elementsList = line.split(', ')
-        app = Application()
-        app.appId = elementsList[0]
-        app.data = []
-        for i in range(1, len(elementsList), 2):
-            app.data.append([elementsList[i], int(elementsList[i+1])])
-        applicationList.append(app)
-        line = inputFile.readline()
-    inputFile.close()
-    return applicationList
+    return list(iterApplicationsFile(filename))
+
+def applicationsDtype(variables, dtype=np.int64, idWidth=4):
+    # structured dtype of readApplicationsArray: appId + one column per variable
+    return np.dtype([('appId', f'U{idWidth}')] + [(variable, dtype) for variable in variables])
+
+def parseApplicationsColumns(lines, variables=None, dtype=np.int64):
+    """
+    Parses a list of application lines at once into a structured
+    array (appId column + one column per variable, in the order of
+    variables, by default the order of the first line). The lines
+    are split in one go and the columns converted by numpy, no
+    Application object is created
+    """
+    tokens = ''.join(lines).replace(',', ' ').split()
+    if not tokens:
+        return np.empty(0, dtype=applicationsDtype(variables or [], dtype))
+    width = len(next(line for line in lines if line.strip()).replace(',', ' ').split())
+    if width % 2 != 1 or len(tokens) % width != 0:
+        raise ValueError("Applications with different number of variables")
+    n = len(tokens) // width
+    names = [tokens[i::width] for i in range(1, width, 2)]
+    values = [tokens[i::width] for i in range(2, width, 2)]
+    order = [column[0] for column in names]
+    if variables is None:
+        variables = order
+
+    appIds = np.array(tokens[0::width])
+    array = np.empty(n, dtype=applicationsDtype(variables, dtype, max(appIds.itemsize // 4, 1)))
+    array['appId'] = appIds
+    if all(column.count(column[0]) == n for column in names):
+        # same order on every line: the columns are read as they are
+        for variable in variables:
+            if variable not in order:
+                raise ValueError(f"Variable {variable} missing in the applications")
+            array[variable] = np.array(values[order.index(variable)], dtype=dtype)
+    else:
+        names = np.array(names).T
+        values = np.array(values).T
+        for variable in variables:
+            found = names == variable
+            if np.any(found.sum(axis=1) != 1):
+                raise ValueError(f"Variable {variable} missing in the applications")
+            array[variable] = values[found].astype(dtype)
+    return array
+
+def iterApplicationsArrays(filename, variables=None, chunk_size=100000, dtype=np.int64):
+    """
+    Columnar version of iterApplicationsFile: yields structured
+    arrays of up to chunk_size applications (see
+    parseApplicationsColumns), ready for FuzzySystem.infer_batch
+    """
+    with open(filename, 'r') as inputFile:
+        while True:
+            lines = list(islice(inputFile, chunk_size))
+            if not lines:
+                break
+            array = parseApplicationsColumns(lines, variables, dtype)
+            if not len(array):
+                continue
+            if variables is None:
+                variables = list(array.dtype.names[1:])
+            yield array
+
+def iterTextRanges(filename, chunk_size=100000):
+    """
+    Byte ranges (start, stop) of consecutive blocks of about
+    chunk_size lines of a text file, cut at the end of a line, so
+    that every block can be read and parsed apart (e.g. by a worker
+    process, see readApplicationsRange). Only the ends of the blocks
+    are read: the size of a line is estimated from the first ones
+    """
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as inputFile:
+        sample = inputFile.read(1 << 16)
+        blockSize = max(int(len(sample) / max(sample.count(b'\n'), 1) * chunk_size), 1)
+        start = 0
+        while start < size:
+            inputFile.seek(start + blockSize - 1)
+            inputFile.readline()
+            stop = min(inputFile.tell(), size)
+            yield start, stop
+            start = stop
+
+def readApplicationsRange(filename, start, stop, variables=None, dtype=np.int64):
+    # structured array of the applications in the bytes [start, stop) of a
+    # text file (see iterTextRanges and parseApplicationsColumns)
+    with open(filename, 'rb') as inputFile:
+        inputFile.seek(start)
+        lines = inputFile.read(stop - start).decode('utf-8').splitlines(True)
+    return parseApplicationsColumns(lines, variables, dtype)
+
+def readApplicationsArray(filename, variables=None, dtype=np.int64):
+    chunks = list(iterApplicationsArrays(filename, variables, dtype=dtype))
+    if not chunks:
+        return np.empty(0, dtype=applicationsDtype(variables or [], dtype))
+    idWidth = max(chunk.dtype['appId'].itemsize // 4 for chunk in chunks)
+    names = chunks[0].dtype.names[1:]
+    return np.concatenate([chunk.astype(applicationsDtype(names, dtype, idWidth)) for chunk in chunks])
+
+def applicationsMatrix(array, variables):
+    # N x len(variables) matrix of the columns of a structured array
+    return np.column_stack([array[variable] for variable in variables])
+
+# Binary applications/results files ______________________________________________
+#
+# Packed records of one or more columns (appId + variables, or appId + Risk),
+# after a fixed-width little-endian header:
+#   magic (8 bytes) | version (uint16) | number of columns (uint16) |
+#   reserved (uint32) | number of records (uint64) | 8 bytes of padding
+#   one 48 byte descriptor per column: name (40 bytes utf-8, NUL padded) and
+#   numpy type (8 bytes ascii, e.g. '<i8', '<f8', '|S4')
+#   padding up to a multiple of 64 bytes
+# The appIds are stored as ASCII bytes. The records start right after the
+# header, so the file is read with np.memmap and nothing is parsed
+
+BINARY_MAGIC = b'MFISBIN\0'
+BINARY_VERSION = 1
+BINARY_PREFIX = struct.Struct('<8sHHIQ8x')
+BINARY_COLUMN = struct.Struct('<40s8s')
+
+def binaryHeader(dtype, count):
+    header = BINARY_PREFIX.pack(BINARY_MAGIC, BINARY_VERSION, len(dtype.names or ()), 0, count)
+    for name in dtype.names or ():
+        encodedName = name.encode('utf-8')
+        if len(encodedName) > 40:
+            raise ValueError(f"Column name {name} longer than 40 bytes")
+        header += BINARY_COLUMN.pack(encodedName, dtype[name].str.encode('ascii'))
+    return header + b'\0' * (-len(header) % 64)
+
+def readBinaryHeader(inputFile):
+    """
+    Reads the header of a binary file, returns the dtype of its
+    records, their number and the offset of the first one
+    """
+    magic, version, columns, _, count = BINARY_PREFIX.unpack(inputFile.read(BINARY_PREFIX.size))
+    if magic != BINARY_MAGIC:
+        raise ValueError("Not a binary applications/results file")
+    if version != BINARY_VERSION:
+        raise ValueError(f"Unsupported binary file version {version}")
+    fields = []
+    for i in range(columns):
+        name, typeName = BINARY_COLUMN.unpack(inputFile.read(BINARY_COLUMN.size))
+        fields.append((name.rstrip(b'\0').decode('utf-8'), typeName.rstrip(b'\0').decode('ascii')))
+    size = BINARY_PREFIX.size + columns * BINARY_COLUMN.size
+    return np.dtype(fields), count, size + (-size % 64)
+
+def binaryDtype(dtype):
+    # same columns with the unicode ones (appId) as ASCII bytes
+    return np.dtype([(name, dtype[name].str.replace('<U', '|S')) for name in dtype.names])
+
+class BinaryWriter:
+    """
+    Appends structured arrays (readApplicationsArray, resultsArray)
+    to a binary file chunk by chunk. The types of the columns are
+    the ones of dtype or of the first array written; the number of
+    records in the header is set by close()
+    """
+
+    def __init__(self, filename, dtype=None):
+        self.file = open(filename, 'wb')
+        self.dtype = None
+        self.count = 0
+        if dtype is not None:
+            self.start(np.dtype(dtype))
+
+    def start(self, dtype):
+        self.dtype = binaryDtype(dtype)
+        self.file.write(binaryHeader(self.dtype, 0))
+
+    def write(self, array):
+        if self.dtype is None:
+            self.start(array.dtype)
+        if array.dtype.names != self.dtype.names:
+            raise ValueError("Columns different from the ones of the file")
+        for name in self.dtype.names:
+            if self.dtype[name].kind == 'S' and len(array) and \
+                    np.char.str_len(array[name]).max() > self.dtype[name].itemsize:
+                raise ValueError(f"Column {name} wider than {self.dtype[name].itemsize} characters")
+        self.file.write(np.ascontiguousarray(array.astype(self.dtype)).tobytes())
+        self.count += len(array)
+
+    def writeRecords(self, data, dtype):
+        # Appends records already packed as dtype (e.g. by a worker process,
+        # see binaryDtype), converted first if the file has other columns
+        if self.dtype is None:
+            self.start(dtype)
+        if dtype != self.dtype:
+            self.write(np.frombuffer(data, dtype=dtype))
+            return
+        self.file.write(data)
+        self.count += len(data) // dtype.itemsize
+
+    def close(self):
+        if self.dtype is None:
+            self.start(np.dtype([]))
+        self.file.seek(0)
+        self.file.write(binaryHeader(self.dtype, self.count))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def writeBinaryFile(filename, array):
+    with BinaryWriter(filename) as writer:
+        writer.write(array)
+
+def readBinaryFile(filename):
+    """
+    Memory maps a binary file: returns a read-only structured
+    array over its records, with the same columns as
+    readApplicationsArray (appId as bytes)
+    """
+    with open(filename, 'rb') as inputFile:
+        dtype, count, offset = readBinaryHeader(inputFile)
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+def iterBinaryArrays(filename, chunk_size=100000):
+    # chunks (views, nothing is copied) of readBinaryFile
+    array = readBinaryFile(filename)
+    for start in range(0, len(array), chunk_size):
+        yield array[start:start + chunk_size]
+
+def resultsArray(appIds, risks, idWidth=16):
+    # structured array (appId, Risk) of a chunk of results, or (appId, one
+    # column per configuration) if risks is a structured array
+    appIds = np.asarray(appIds).astype(str)
+    risks = np.asarray(risks)
+    width = max(idWidth, appIds.dtype.itemsize // 4)
+    columns = [(name, risks.dtype[name]) for name in risks.dtype.names] if risks.dtype.names \
+        else [('Risk', risks.dtype)]
+    array = np.empty(len(appIds), dtype=[('appId', f'U{width}')] + columns)
+    array['appId'] = appIds
+    if risks.dtype.names:
+        for name in risks.dtype.names:
+            array[name] = risks[name]
+    else:
+        array['Risk'] = risks
+    return array
+
+def textToBinary(textFile, binaryFile, dtype=np.int64, chunk_size=100000):
+    """
+    Converts an applications or results text file ("0001, Risk, 40")
+    to the binary format. dtype of the values: np.float64 for float
+    inputs or centroid/bisector/mom results
+    """
+    with open(textFile, 'r') as inputFile:
+        idWidth = max((len(line.split(',', 1)[0].strip()) for line in inputFile if line.strip()), default=1)
+    with BinaryWriter(binaryFile) as writer:
+        for array in iterApplicationsArrays(textFile, chunk_size=chunk_size, dtype=dtype):
+            if writer.dtype is None:
+                writer.start(applicationsDtype(array.dtype.names[1:], dtype, idWidth))
+            writer.write(array)
 
+def binaryToText(binaryFile, textFile, chunk_size=100000):
+    # Inverse of textToBinary: one "appId, column, value, ..." line per record
+    array = readBinaryFile(binaryFile)
+    names = array.dtype.names[1:]
+    line = "{}" + "".join(f", {name}, {{}}" for name in names) + "\n"
+    with open(textFile, 'w') as outputFile:
+        for start in range(0, len(array), chunk_size):
+            chunk = array[start:start + chunk_size]
+            columns = [chunk['appId'].astype(str).tolist()] + [chunk[name].tolist() for name in names]
+            outputFile.writelines([line.format(*row) for row in zip(*columns)])
@@ -0,0 +1,143 @@
+import argparse
+import sys
+import numpy as np
+import MFIS_Classes as classes
+import MFIS_Engine as engine
+import MFIS_Read_Functions as loader
+
+# Static analysis of a rule base against its fuzzy sets, and the minimized
+# rule base that gives the same risks:
+#   never_fire:  rules whose antecedents are never all nonzero together (a set
+#                with an empty support, or sets of one variable with disjoint
+#                supports), their strength is always 0
+#   duplicates:  rules with the same consequent and antecedents as an earlier one
+#   subsumed:    rules with the same consequent as a stronger rule: every
+#                antecedent of the stronger rule has one in the subsumed rule
+#                whose membership is lower or equal everywhere (the same set,
+#                or a narrower one), so the subsumed strength is never higher
+#   conflicts:   rules with the same antecedents and different consequents
+#                (only reported)
+#
+# With the clip and scale consequents, the similarity of a risk set is the max
+# of the strengths of its rules, which does not change without those rules:
+# the risks of the minimized base are identical, for every defuzzification and
+# engine. The Sugeno average adds up the strengths of all the rules, so only
+# the rules that never fire can be removed (their strength is 0).
+#
+# The memberships are compared as the compiled model evaluates them: on the
+# sampled tables (integer inputs) by default, or as identical trapezoids and
+# universes in parametric membership_mode
+
+
+class RuleAnalysis:
+
+    def __init__(self, fuzzyRisks: classes.FuzzySetsDict, fuzzyVars: classes.FuzzySetsDict,
+                 rules: classes.RuleList, parametric: bool = False):
+        self.rules = rules
+        model = engine.CompiledModel(fuzzyRisks, fuzzyVars, rules, parametric)
+        fireable, nonempty = model.satisfiable()
+        names = [rule.ruleName for rule in rules]
+
+        self.empty_sets: list[str] = [setid for setid, ok in zip(model.setids, nonempty) if not ok]
+        self.never_fire: list[str] = [name for name, ok in zip(names, fireable) if not ok]
+
+        # antecedents of every rule as a set of indexes into model.setids
+        n_sets = len(model.setids)
+        antecedents = [frozenset(int(i) for i in row if i != n_sets) for row in model.antecedents]
+        dominates = self._dominance(model)
+
+        self.duplicates: dict[str, str] = {}
+        self.conflicts: list[tuple[str, str]] = []
+        first = {}
+        for i, rule in enumerate(rules):
+            key = (rule.consequent, antecedents[i])
+            if key in first:
+                self.duplicates[rule.ruleName] = names[first[key]]
+            else:
+                first[key] = i
+        seen = {}
+        for i, rule in enumerate(rules):
+            other = seen.setdefault(antecedents[i], i)
+            if rules[other].consequent != rule.consequent:
+                self.conflicts.append((names[other], rule.ruleName))
+
+        # A rule is removed if a rule still kept is at least as strong
+        # everywhere: the earlier one is kept when both are as strong
+        self.subsumed: dict[str, str] = {}
+        removed = {i for i in range(len(rules)) if not fireable[i] or names[i] in self.duplicates}
+        for i in range(len(rules)):
+            if i in removed:
+                continue
+            for k in range(len(rules)):
+                if k == i or k in removed or rules[k].consequent != rules[i].consequent:
+                    continue
+                if self._stronger(antecedents[k], antecedents[i], dominates) and \
+                        (k < i or not self._stronger(antecedents[i], antecedents[k], dominates)):
+                    self.subsumed[names[i]] = names[k]
+                    removed.add(i)
+                    break
+
+    @staticmethod
+    def _dominance(model: engine.CompiledModel) -> np.ndarray:
+        # sets x sets, [a, b]: the membership of b is lower or equal to that of a
+        # for every input of the model
+        n_sets = len(model.setids)
+        same_var = model.set_var[:n_sets, None] == model.set_var[None, :n_sets]
+        if model.parametric:
+            trapezoids = np.concatenate([model.set_trapezoids, model.set_bounds], axis=1)[:n_sets]
+            lower = (trapezoids[:, None, :] == trapezoids[None, :, :]).all(axis=2)
+        else:
+            table = model.table[:n_sets]
+            lower = (table[None, :, :] <= table[:, None, :]).all(axis=2)
+        return same_var & lower
+
+    @staticmethod
+    def _stronger(strong: frozenset, weak: frozenset, dominates: np.ndarray) -> bool:
+        # min over weak <= min over strong, for every input
+        return all(any(dominates[a, b] for b in weak) for a in strong)
+
+    def minimized(self, sugeno: bool = False) -> classes.RuleList:
+        # Rule base without the rules that never fire, the duplicates and the
+        # subsumed rules (sugeno: only without the rules that never fire)
+        removed = set(self.never_fire)
+        if not sugeno:
+            removed |= set(self.duplicates) | set(self.subsumed)
+        minimized = classes.RuleList()
+        for rule in self.rules:
+            if rule.ruleName not in removed:
+                minimized.append(rule)
+        return minimized
+
+    def printAnalysis(self) -> None:
+        print("_____________ Rule analysis ______________\n")
+        print("Rules:           ", len(self.rules))
+        print("Empty sets:      ", ", ".join(self.empty_sets) or "-")
+        print("Never fire:      ", ", ".join(self.never_fire) or "-")
+        print("Duplicates:      ", ", ".join(f"{rule} (of {other})" for rule, other in self.duplicates.items()) or "-")
+        print("Subsumed:        ", ", ".join(f"{rule} (by {other})" for rule, other in self.subsumed.items()) or "-")
+        print("Conflicts:       ", ", ".join(f"{a} / {b}" for a, b in self.conflicts) or "-")
+        print("Minimized:       ", len(self.minimized()), "rules")
+        print()
+
+
+def main_analysis(arguments: list[str] = None) -> int:
+    # python MFIS_RuleAnalysis.py [--rules Rules.txt] [--output MinimizedRules.txt]
+    parser = argparse.ArgumentParser(description="Static analysis and minimization of the rule base")
+    parser.add_argument("--risks", default="Risks.txt")
+    parser.add_argument("--sets", default="InputVarSets.txt")
+    parser.add_argument("--rules", default="Rules.txt")
+    parser.add_argument("--membership", default="table", choices=["table", "parametric"])
+    parser.add_argument("--sugeno", action="store_true", help="minimize for the sugeno consequents")
+    parser.add_argument("--output", help="file for the minimized rule base")
+    args = parser.parse_args(arguments)
+
+    analysis = RuleAnalysis(loader.readFuzzySetsFile(args.risks), loader.readFuzzySetsFile(args.sets),
+                            loader.readRulesFile(args.rules), args.membership == 'parametric')
+    analysis.printAnalysis()
+    if args.output:
+        loader.writeRulesFile(args.output, analysis.minimized(args.sugeno))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_analysis())
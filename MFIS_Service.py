@@ -0,0 +1,308 @@
+import argparse
+import asyncio
+import json
+import math
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import MFIS_Classes as classes
+
+# Local scoring service: a FuzzySystem loaded once and served over HTTP on
+# localhost with asyncio. Concurrent requests are queued and scored together
+# in micro-batches (at most batch_size applications, waiting at most max_wait
+# seconds for more to come) with FuzzySystem.infer_batch, on a thread of its
+# own so the event loop keeps accepting requests meanwhile.
+#
+#   POST /score    {"appId": "0001", "data": {"Age": 35, ...}}, or a list of them
+#                  -> {"appId": "0001", "risk": 40} (null if undefined), or a list
+#   GET  /stats    requests, batches, queue, latency percentiles and throughput (JSON)
+#   GET  /metrics  the same in the Prometheus text format
+#
+# Backpressure: at most max_pending applications wait in the queue, the
+# requests that do not fit are answered 503 at once.
+
+
+class Busy(Exception):
+    # The queue of the service is full
+    pass
+
+
+class ScoringService:
+
+    def __init__(self, fuzzySystem, batch_size: int = 64, max_wait: float = 0.002, max_pending: int = 10000):
+        self.fuzzySystem = fuzzySystem
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self.variables: list[str] = fuzzySystem.variables
+
+        self.metrics = classes.Metrics()    # "request" and "batch" latencies
+        self.requests = 0
+        self.rejected = 0
+        self.batches = 0
+        self.rules_applied = [0] * len(fuzzySystem.rules)
+        self.started = time.perf_counter()
+
+        self.queue: asyncio.Queue = None
+        self.executor = ThreadPoolExecutor(1)
+        self.server: asyncio.AbstractServer = None
+        self._batcher: asyncio.Task = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8765) -> None:
+        self.queue = asyncio.Queue(self.max_pending)
+        self._batcher = asyncio.create_task(self._batch_loop())
+        self.server = await asyncio.start_server(self._handle, host, port)
+
+    async def stop(self) -> None:
+        self.server.close()
+        await self.server.wait_closed()
+        self._batcher.cancel()
+        self.executor.shutdown()
+
+    @property
+    def port(self) -> int:
+        return self.server.sockets[0].getsockname()[1]
+
+# Scoring ______________________________________________
+
+    async def score(self, data: dict) -> float:
+        # Risk of one application {variable: value}, scored in the next batch.
+        # Its inputs are checked here (FuzzySystem.input_row) so that a bad
+        # request fails alone (ValueError, KeyError or TypeError), never its batch
+        return await self._submit(self.fuzzySystem.input_row(data))
+
+    async def _submit(self, values: np.ndarray) -> float:
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((values, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise Busy()
+        return await future
+
+    async def _batch_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            start = time.perf_counter()
+            try:
+                matrix = np.stack([values for values, _, _ in batch])
+                risks = await loop.run_in_executor(self.executor, self._score_batch, matrix)
+            except Exception as error:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            end = time.perf_counter()
+            self.metrics.record("batch", end - start)
+            self.batches += 1
+            for (_, future, arrived), risk in zip(batch, risks.tolist()):
+                self.metrics.record("request", end - arrived)
+                if not future.done():
+                    future.set_result(risk)
+
+    def _score_batch(self, matrix: np.ndarray) -> np.ndarray:
+        return self.fuzzySystem.infer_batch(matrix, self.rules_applied)
+
+    def stats(self) -> dict:
+        uptime = time.perf_counter() - self.started
+        scored = self.metrics.stages.get("request", [0])[0]
+        stats = {
+            "requests": self.requests,
+            "applications": scored,
+            "rejected": self.rejected,
+            "batches": self.batches,
+            "mean_batch_size": scored / self.batches if self.batches else None,
+            "queue": self.queue.qsize() if self.queue is not None else 0,
+            "uptime": uptime,
+            "throughput": scored / uptime if uptime else None,
+        }
+        for stage in ("request", "batch"):
+            if stage in self.metrics.stages:
+                stats[f"{stage}_latency"] = {str(q): value for q, value in self.metrics.percentiles(stage).items()}
+        return stats
+
+# HTTP ______________________________________________
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # HTTP/1.1 with keep-alive, one request after another
+        try:
+            while True:
+                requestLine = await reader.readline()
+                if not requestLine.strip():
+                    break
+                method, path, version = requestLine.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, contentType, payload = await self._route(method, path, body)
+                close = headers.get('connection', '').lower() == 'close' or version == 'HTTP/1.0'
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: {contentType}\r\nContent-Length: {len(payload)}\r\n"
+                    f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n".encode('latin-1') + payload
+                )
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method: str, path: str, body: bytes):
+        # (status, content type, payload) of one request
+        if method == 'GET' and path == '/stats':
+            return "200 OK", "application/json", json.dumps(self.stats()).encode()
+        if method == 'GET' and path == '/metrics':
+            rules = {rule.ruleName: count for rule, count in zip(self.fuzzySystem.rules, self.rules_applied)}
+            return "200 OK", "text/plain; version=0.0.4", self.metrics.toPrometheus(rules).encode()
+        if method != 'POST' or path != '/score':
+            return "404 Not Found", "application/json", b'{"error": "not found"}'
+
+        self.requests += 1
+        try:
+            request = json.loads(body)
+            applications = request if isinstance(request, list) else [request]
+            if self.queue.qsize() + len(applications) > self.max_pending:
+                # all the applications of a request or none
+                self.rejected += len(applications)
+                raise Busy()
+            rows = [self.fuzzySystem.input_row(application["data"]) for application in applications]
+            risks = await asyncio.gather(*[self._submit(values) for values in rows])
+        except Busy:
+            return "503 Service Unavailable", "application/json", b'{"error": "busy"}'
+        except (ValueError, KeyError, TypeError) as error:
+            return "400 Bad Request", "application/json", json.dumps({"error": repr(error)}).encode()
+
+        results = [{"appId": application.get("appId"), "risk": None if math.isnan(risk) else risk}
+                   for application, risk in zip(applications, risks)]
+        return "200 OK", "application/json", json.dumps(results if isinstance(request, list) else results[0]).encode()
+
+
+# Load generator ______________________________________________
+
+async def load_generator(host: str, port: int, applications: list[dict], requests: int = 10000,
+                         concurrency: int = 64) -> dict:
+    # Sends requests POST /score (cycling over applications, {"appId", "data"})
+    # from concurrency keep-alive connections, and returns the latencies seen
+    # by the clients and the throughput
+    latencies = []
+    answers = {"200": 0}
+    counter = iter(range(requests))
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        for i in counter:
+            body = json.dumps(applications[i % len(applications)]).encode()
+            start = time.perf_counter()
+            writer.write(f"POST /score HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                         f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+            status = (await reader.readline()).split()[1].decode()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            answers[status] = answers.get(status, 0) + 1
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies)
+    return {
+        "requests": len(latencies),
+        "statuses": answers,
+        "seconds": elapsed,
+        "throughput": len(latencies) / elapsed,
+        "latency": {str(q): float(np.quantile(latencies, q)) for q in (0.5, 0.9, 0.99)},
+    }
+
+
+def read_requests(filename: str) -> list[dict]:
+    # Applications of a text file as /score requests
+    import MFIS_Read_Functions as loader
+    array = loader.readApplicationsArray(filename)
+    return [{"appId": str(row["appId"]), "data": {name: row[name].item() for name in array.dtype.names[1:]}}
+            for row in array]
+
+
+async def serve(fuzzySystem, host: str, port: int, batch_size: int, max_wait: float, max_pending: int) -> None:
+    service = ScoringService(fuzzySystem, batch_size, max_wait, max_pending)
+    await service.start(host, port)
+    print(f"Scoring on http://{host}:{service.port}/score")
+    async with service.server:
+        await service.server.serve_forever()
+
+
+def main_service(arguments: list[str] = None) -> int:
+    # python MFIS_Service.py [--port 8765] [--batch-size 64] [--max-wait 0.002]
+    # python MFIS_Service.py --load 10000 [--concurrency 64]   (against a running service)
+    parser = argparse.ArgumentParser(description="Local scoring service of the fuzzy inference system")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--risks", default="Risks.txt")
+    parser.add_argument("--sets", default="InputVarSets.txt")
+    parser.add_argument("--rules", default="Rules.txt")
+    parser.add_argument("--snapshot", help="compiled model snapshot, rebuilt if the text files changed")
+    parser.add_argument("--consequents", default="S")
+    parser.add_argument("--defuzz", default="som")
+    parser.add_argument("--engine", default="sampled", choices=["sampled", "analytic"])
+    parser.add_argument("--membership", default="table", choices=["table", "parametric"])
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--max-wait", type=float, default=0.002, help="seconds waited to fill a batch")
+    parser.add_argument("--max-pending", type=int, default=10000, help="queued applications before 503")
+    parser.add_argument("--load", type=int, help="run the load generator with this number of requests")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--applications", default="Applications.txt", help="requests of the load generator")
+    args = parser.parse_args(arguments)
+
+    if args.load:
+        report = asyncio.run(load_generator(args.host, args.port, read_requests(args.applications),
+                                            args.load, args.concurrency))
+        print(json.dumps(report, indent=2))
+        return 0
+
+    from main import FuzzySystem
+    options = {
+        "consequents_mode": args.consequents,
+        "defuzz_mode": args.defuzz,
+        "defuzz_engine": args.engine,
+        "membership_mode": args.membership,
+        "debug": {'fuzzySets': False, 'rules': False, 'plot': False, 'rules_applied': False}
+    }
+    fuzzySystem = FuzzySystem.from_files(args.risks, args.sets, args.rules, options, args.snapshot)
+    try:
+        asyncio.run(serve(fuzzySystem, args.host, args.port, args.batch_size, args.max_wait, args.max_pending))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_service())
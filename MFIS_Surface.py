@@ -0,0 +1,135 @@
+import json
+import numpy as np
+
+# Precomputed risk surface: the defuzzified risk of a FuzzySystem over the
+# product of the universes of its input variables (or a declared sub-grid),
+# built with the batch engine and saved as a .npy file. RiskSurface serves it
+# through np.memmap, so several scoring processes share the same pages
+# without loading the surface.
+#
+# The metadata (variables, axes, tolerances, options) is saved next to it in
+# <filename>.json
+
+
+def default_axes(fuzzySystem) -> dict:
+    # Integer universe of every input variable, as sampled by its fuzzy sets
+    axes = {}
+    for variable in fuzzySystem.variables:
+        sets = [fuzzySet for fuzzySet in fuzzySystem.fuzzyVars.values() if fuzzySet.var == variable]
+        xmin = min(fuzzySet.xmin for fuzzySet in sets)
+        xmax = max(fuzzySet.xmax for fuzzySet in sets)
+        axes[variable] = np.arange(xmin, xmax)
+    return axes
+
+
+def build_surface(fuzzySystem, filename: str, axes: dict = None, tolerances: dict = None,
+                  block_size: int = 100000, dtype=np.float64) -> None:
+    # axes: {variable: sorted grid values}, the integer universe of the
+    #       variables missing from it (all of them by default)
+    # tolerances: {variable: distance}, inputs closer than that to the grid
+    #       are interpolated between its points, the rest are only served on
+    #       the grid points (default 0)
+    full = default_axes(fuzzySystem)
+    axes = dict(full, **(axes or {}))
+    tolerances = tolerances or {}
+    variables = fuzzySystem.variables
+    grid = [np.asarray(axes[variable]) for variable in variables]
+    shape = tuple(len(axis) for axis in grid)
+
+    surface = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape)
+    flat = surface.reshape(-1)
+    total = flat.shape[0]
+    for start in range(0, total, block_size):
+        end = min(start + block_size, total)
+        coordinates = np.unravel_index(np.arange(start, end), shape)
+        matrix = np.column_stack([grid[i][coordinates[i]] for i in range(len(variables))])
+        flat[start:end] = fuzzySystem.infer_batch(matrix, cache=False)
+    surface.flush()
+    del surface
+
+    metadata = {
+        "variables": variables,
+        "axes": [axis.tolist() for axis in grid],
+        "tolerances": [float(tolerances.get(variable, 0)) for variable in variables],
+        # the inputs out of the full universe are clamped by the model itself
+        "clamp": [bool(np.array_equal(grid[i], full[variable])) for i, variable in enumerate(variables)],
+        "options": {name: value for name, value in fuzzySystem.options.items() if name != "debug"},
+    }
+    with open(filename + ".json", "w") as file:
+        json.dump(metadata, file)
+
+
+class RiskSurface:
+    # Read-only, memory-mapped risk surface written by build_surface
+
+    def __init__(self, filename: str):
+        with open(filename + ".json", "r") as file:
+            metadata = json.load(file)
+        self.variables: list[str] = metadata["variables"]
+        self.axes = [np.asarray(axis) for axis in metadata["axes"]]
+        self.tolerances = np.asarray(metadata["tolerances"], dtype=float)
+        self.clamp = np.asarray(metadata["clamp"], dtype=bool)
+        self.options: dict = metadata["options"]
+        self.surface = np.load(filename, mmap_mode='r')
+
+    def lookup(self, matrix) -> np.ndarray:
+        # Risks of the N x len(self.variables) input matrix. Grid points are
+        # read directly, inputs between grid points within the tolerance of
+        # their variable are interpolated (multilinear) from the points around
+        # them. Other inputs raise ValueError
+        matrix = np.asarray(matrix, dtype=float).reshape(-1, len(self.variables))
+        n, d = matrix.shape
+        lower = np.empty((n, d), dtype=np.intp)
+        weight = np.empty((n, d))
+        for j, axis in enumerate(self.axes):
+            values = matrix[:, j]
+            if self.clamp[j]:
+                values = np.clip(values, axis[0], axis[-1])
+            index = np.clip(np.searchsorted(axis, values, side='right') - 1, 0, max(len(axis) - 2, 0))
+            if len(axis) > 1:
+                weight[:, j] = (values - axis[index]) / (axis[index + 1] - axis[index])
+            else:
+                weight[:, j] = values - axis[index]
+            lower[:, j] = index
+
+            # distance to the closest grid point
+            distance = np.minimum(np.abs(weight[:, j]), np.abs(1 - weight[:, j])) * \
+                (axis[index + 1] - axis[index] if len(axis) > 1 else 1)
+            outside = (values < axis[0]) | (values > axis[-1]) | (distance > self.tolerances[j])
+            on_grid = (weight[:, j] == 0) | (weight[:, j] == 1)
+            if np.any(outside & ~on_grid):
+                raise ValueError(f"{self.variables[j]} out of the grid or its tolerance")
+
+        # Points exactly on the grid: one gather
+        snapped = lower + (weight == 1)
+        output = np.asarray(self.surface[tuple(snapped.T)], dtype=float)
+
+        between = np.flatnonzero(((weight > 0) & (weight < 1)).any(axis=1))
+        if between.size:
+            output[between] = self._interpolate(lower[between], weight[between])
+        return output
+
+    def _interpolate(self, lower: np.ndarray, weight: np.ndarray) -> np.ndarray:
+        # Sum over the 2^d corners of the cell, only varying the axes where the
+        # input is between two points
+        n, d = lower.shape
+        moving = [j for j in range(d) if ((weight[:, j] > 0) & (weight[:, j] < 1)).any()]
+        lower = lower + (weight == 1)
+        weight = np.where(weight == 1, 0, weight)
+        last = np.asarray(self.surface.shape) - 1
+        output = np.zeros(n)
+        for corner in range(2 ** len(moving)):
+            index = lower.copy()
+            factor = np.ones(n)
+            for bit, j in enumerate(moving):
+                if corner >> bit & 1:
+                    index[:, j] += 1
+                    factor *= weight[:, j]
+                else:
+                    factor *= 1 - weight[:, j]
+            # moving is of the whole batch: a row on the grid along one of
+            # these axes has a factor 0 there, never 0 x NaN (no rule fired)
+            values = self.surface[tuple(np.minimum(index, last).T)]
+            with np.errstate(invalid='ignore'):
+                output += np.where(factor > 0, factor * values, 0)
+        return output
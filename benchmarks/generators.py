@@ -0,0 +1,48 @@
+import random
+import numpy as np
+
+# Synthetic inputs for the benchmarks, in the same text formats as
+# Applications.txt and Rules.txt, built from the sets of InputVarSets.txt and
+# Risks.txt so that every value and setid is valid for the FuzzySystem
+
+
+def variable_universes(fuzzyVars) -> dict:
+    # {variable: (xmin, xmax)} covering all the sets of each variable
+    universes = {}
+    for fuzzySet in fuzzyVars.values():
+        xmin, xmax = universes.get(fuzzySet.var, (fuzzySet.xmin, fuzzySet.xmax))
+        universes[fuzzySet.var] = (min(xmin, fuzzySet.xmin), max(xmax, fuzzySet.xmax))
+    return universes
+
+
+def generate_portfolio(filename: str, rows: int, fuzzyVars, seed: int = 0, chunk_size: int = 100000) -> None:
+    # rows applications with integer values drawn uniformly from the universe
+    # of every variable, written chunk by chunk
+    universes = variable_universes(fuzzyVars)
+    rng = np.random.default_rng(seed)
+    width = max(4, len(str(rows)))
+    line = "{:0" + str(width) + "d}" + "".join(f", {variable}, {{}}" for variable in universes) + "\n"
+    with open(filename, "w") as file:
+        for start in range(0, rows, chunk_size):
+            end = min(start + chunk_size, rows)
+            columns = [rng.integers(xmin, xmax, end - start).tolist() for xmin, xmax in universes.values()]
+            file.writelines([line.format(appId, *values)
+                             for appId, values in zip(range(start + 1, end + 1), zip(*columns))])
+
+
+def generate_rules(filename: str, count: int, fuzzyRisks, fuzzyVars, seed: int = 0,
+                   min_antecedents: int = 1, max_antecedents: int = 4) -> None:
+    # count rules, each one with a random consequent and 1 to 4 antecedents
+    # on different variables
+    rand = random.Random(seed)
+    setids = {}
+    for setid, fuzzySet in fuzzyVars.items():
+        setids.setdefault(fuzzySet.var, []).append(setid)
+    variables = list(setids)
+    labels = list(fuzzyRisks)
+    width = len(str(count))
+    with open(filename, "w") as file:
+        for i in range(count):
+            size = rand.randint(min_antecedents, min(max_antecedents, len(variables)))
+            antecedents = [rand.choice(setids[variable]) for variable in rand.sample(variables, size)]
+            file.write(", ".join([f"Rule{i + 1:0{width}d}", rand.choice(labels)] + antecedents) + "\n")
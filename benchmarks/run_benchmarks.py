@@ -0,0 +1,295 @@
+import argparse
+import filecmp
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import deque
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main
+import MFIS_Read_Functions as loader
+import MFIS_Surface as surfaces
+from generators import generate_portfolio, generate_rules
+
+# Benchmark suite of the FuzzySystem: times reading, processing and every
+# inference stage on synthetic portfolios (rows) and rule bases (rules), and
+# the peak of memory allocated while processing. The results are saved as
+# JSON and can be compared against a saved baseline:
+#
+#   python benchmarks/run_benchmarks.py --output baseline.json
+#   python benchmarks/run_benchmarks.py --baseline baseline.json --threshold 0.2
+#
+# The 52 applications of Applications.txt must still give Results.txt (the
+# correctness oracle), and infer_batch the same risks as the skfuzzy path of
+# inference in every configuration, before anything is timed:
+#
+#   python benchmarks/run_benchmarks.py --check-only
+
+OPTIONS = {
+    "consequents_mode": "S",
+    "defuzz_mode": "som",
+    "defuzz_engine": "sampled",
+    "membership_mode": "table",
+    "metrics": True,
+    "debug": {
+        'fuzzySets': False,
+        'rules': False,
+        'plot': False,
+        'rules_applied': False
+    }
+}
+
+
+def load_sets():
+    fuzzyRisks = loader.readFuzzySetsFile(os.path.join(ROOT, 'Risks.txt'))
+    fuzzyVars = loader.readFuzzySetsFile(os.path.join(ROOT, 'InputVarSets.txt'))
+    return fuzzyRisks, fuzzyVars
+
+
+def timed(function, *args, **kwargs):
+    # (seconds, result) of one call
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def peak_memory(function, *args, **kwargs) -> int:
+    # Peak of bytes allocated (Python and numpy) during one call
+    tracemalloc.start()
+    try:
+        function(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def check_oracle(directory: str) -> bool:
+    # Results.txt must be reproduced exactly by both processing paths
+    fuzzyRisks, fuzzyVars = load_sets()
+    rules = loader.readRulesFile(os.path.join(ROOT, 'Rules.txt'))
+    applications = os.path.join(ROOT, 'Applications.txt')
+    expected = os.path.join(ROOT, 'Results.txt')
+    fuzzySystem = main.FuzzySystem(fuzzyRisks, fuzzyVars, rules, dict(OPTIONS, metrics=False))
+
+    output = os.path.join(directory, 'oracle.txt')
+    fuzzySystem.process(loader.iterApplicationsFile(applications), filename=output)
+    same = filecmp.cmp(output, expected, shallow=False)
+    fuzzySystem.process_arrays(loader.iterApplicationsArrays(applications), output)
+    return same and filecmp.cmp(output, expected, shallow=False)
+
+
+def check_configurations(applications: str = None) -> list[str]:
+    # Configurations (consequents_mode, defuzz_mode) where infer_batch is not
+    # bit-identical to inference, one application at a time through skfuzzy
+    fuzzyRisks, fuzzyVars = load_sets()
+    rules = loader.readRulesFile(os.path.join(ROOT, 'Rules.txt'))
+    applications = loader.readApplicationsFile(applications or os.path.join(ROOT, 'Applications.txt'))
+    failures = []
+    for consequents, method in main.CONFIGURATIONS:
+        options = dict(OPTIONS, consequents_mode=consequents, defuzz_mode=method, metrics=False)
+        fuzzySystem = main.FuzzySystem(fuzzyRisks, fuzzyVars, rules, options)
+        expected = np.array([fuzzySystem.inference(application) for application in applications], dtype=float)
+        risks = fuzzySystem.infer_batch(fuzzySystem.application_matrix(applications), cache=False)
+        if not np.array_equal(risks, expected, equal_nan=True):
+            failures.append(f"{consequents}-{method}")
+    return failures
+
+
+def check_surface(directory: str) -> bool:
+    # A lookup of the risk surface must not depend on the other rows of the
+    # batch: interpolated rows, moving along different axes, next to cells
+    # with no rule fired (NaN with centroid)
+    fuzzyRisks, fuzzyVars = load_sets()
+    rules = loader.readRulesFile(os.path.join(ROOT, 'Rules.txt'))
+    options = dict(OPTIONS, consequents_mode='C', defuzz_mode='centroid', metrics=False)
+    fuzzySystem = main.FuzzySystem(fuzzyRisks, fuzzyVars, rules, options)
+    full = surfaces.default_axes(fuzzySystem)
+    axes = {variable: np.linspace(axis[0], axis[-1], 5).round() for variable, axis in full.items()}
+    tolerances = {variable: float(np.diff(axis).max()) for variable, axis in axes.items()}
+    filename = os.path.join(directory, 'surface.npy')
+    surfaces.build_surface(fuzzySystem, filename, axes, tolerances)
+    surface = surfaces.RiskSurface(filename)
+
+    rng = np.random.default_rng(0)
+    points = np.column_stack([rng.choice(axis[:-1], 2000) for axis in surface.axes]).astype(float)
+    steps = np.column_stack([np.diff(axis)[0] for axis in surface.axes]) * rng.random(points.shape)
+    # every row between grid points on its own axes only
+    matrix = points + steps * (rng.random(points.shape) < 0.3)
+    batched = surface.lookup(matrix)
+    single = np.array([surface.lookup(row)[0] for row in matrix])
+    del surface
+    return bool(np.isnan(single).any() and np.array_equal(batched, single, equal_nan=True))
+
+
+def run_case(applications: str, rules_file: str, rows: int, process_limit: int, memory: bool) -> dict:
+    # Timings of one portfolio and rule base
+    fuzzyRisks, fuzzyVars = load_sets()
+    rules = loader.readRulesFile(rules_file)
+    output = applications + '.out'
+    case = {"rows": rows, "rules": len(rules)}
+
+    # read_applications: the whole portfolio as a list of Application objects
+    # (held in memory, only within process_limit), stream_applications: the
+    # objects streamed and dropped, as process reads them
+    if rows <= process_limit:
+        case["read_applications"], _ = timed(loader.readApplicationsFile, applications)
+    case["stream_applications"], _ = timed(deque, loader.iterApplicationsFile(applications), maxlen=0)
+    case["read_columns"], _ = timed(loader.readApplicationsArray, applications)
+
+    if rows <= process_limit:
+        fuzzySystem = main.FuzzySystem(fuzzyRisks, fuzzyVars, rules, dict(OPTIONS))
+        case["process"], _ = timed(fuzzySystem.process, loader.iterApplicationsFile(applications), filename=output)
+        case["stages"] = stage_seconds(fuzzySystem)
+
+    # chunks small enough for the rows x rules strengths of the batch path
+    chunk_size = max(100, 5000000 // max(len(rules), 1))
+    fuzzySystem = main.FuzzySystem(fuzzyRisks, fuzzyVars, rules, dict(OPTIONS))
+    case["process_arrays"], _ = timed(fuzzySystem.process_arrays,
+                                      loader.iterApplicationsArrays(applications, chunk_size=chunk_size), output)
+    case["batch_stages"] = stage_seconds(fuzzySystem)
+
+    if memory:
+        if rows <= process_limit:
+            fuzzySystem = main.FuzzySystem(fuzzyRisks, fuzzyVars, rules, dict(OPTIONS, metrics=False))
+            case["process_peak_bytes"] = peak_memory(fuzzySystem.process, loader.iterApplicationsFile(applications),
+                                                     filename=output)
+        fuzzySystem = main.FuzzySystem(fuzzyRisks, fuzzyVars, rules, dict(OPTIONS, metrics=False))
+        case["peak_bytes"] = peak_memory(fuzzySystem.process_arrays,
+                                         loader.iterApplicationsArrays(applications, chunk_size=chunk_size), output)
+    os.remove(output)
+    return case
+
+
+def stage_seconds(fuzzySystem) -> dict:
+    report = fuzzySystem.metrics.report()
+    return {stage: entry["seconds"] for stage, entry in report["stages"].items()}
+
+
+def flatten(results: dict) -> dict:
+    # {"portfolio/rows=1000/rules=50/process": seconds, ...} of every timing
+    values = {}
+    for group in ("portfolios", "rule_bases"):
+        for case in results.get(group, []):
+            prefix = f"{group}/rows={case['rows']}/rules={case['rules']}"
+            for name, value in case.items():
+                if isinstance(value, dict):
+                    for stage, seconds in value.items():
+                        values[f"{prefix}/{name}/{stage}"] = seconds
+                elif name not in ("rows", "rules"):
+                    values[f"{prefix}/{name}"] = value
+    return values
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    # Timings (and memory peaks) more than threshold above the baseline
+    current, previous = flatten(results), flatten(baseline)
+    regressions = []
+    for key, value in current.items():
+        if previous.get(key) and value > previous[key] * (1 + threshold):
+            regressions.append(f"{key}: {previous[key]:.6g} -> {value:.6g} (+{value / previous[key] - 1:.0%})")
+    return regressions
+
+
+def parse_sizes(text: str) -> list[int]:
+    return [int(float(size)) for size in text.split(',') if size]
+
+
+def main_benchmarks(arguments=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks of the fuzzy inference system")
+    parser.add_argument("--rows", default="1000,10000,100000",
+                        help="portfolio sizes, comma separated (up to 1e7)")
+    parser.add_argument("--rules", default="20,100,1000,10000",
+                        help="rule base sizes, comma separated")
+    parser.add_argument("--rule-rows", type=int, default=10000,
+                        help="portfolio size used for the rule bases")
+    parser.add_argument("--process-limit", type=int, default=1000000,
+                        help="largest portfolio also timed with process (one Application at a time)")
+    parser.add_argument("--no-memory", action="store_true", help="do not measure the memory peaks")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="JSON of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative slowdown reported as a regression")
+    parser.add_argument("--check-only", action="store_true", help="only run the correctness checks")
+    args = parser.parse_args(arguments)
+
+    fuzzyRisks, fuzzyVars = load_sets()
+    with tempfile.TemporaryDirectory() as directory:
+        # also a synthetic portfolio, with applications no rule fires on
+        synthetic = os.path.join(directory, 'applications_check.txt')
+        generate_portfolio(synthetic, 500, fuzzyVars, args.seed)
+        failures = check_configurations() + check_configurations(synthetic)
+    print("infer_batch vs inference:", "ok" if not failures else "FAILED " + ", ".join(failures))
+    if failures:
+        return 1
+
+    results = {
+        "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                        "platform": platform.platform(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "portfolios": [],
+        "rule_bases": [],
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        results["oracle"] = check_oracle(directory)
+        print("Oracle (Results.txt):", "ok" if results["oracle"] else "FAILED")
+        if not results["oracle"]:
+            return 1
+        surface = check_surface(directory)
+        print("Risk surface, batched vs one row:", "ok" if surface else "FAILED")
+        if not surface:
+            return 1
+        if args.check_only:
+            return 0
+
+        rules_file = os.path.join(ROOT, 'Rules.txt')
+        for rows in parse_sizes(args.rows):
+            applications = os.path.join(directory, f'applications_{rows}.txt')
+            generate_portfolio(applications, rows, fuzzyVars, args.seed)
+            case = run_case(applications, rules_file, rows, args.process_limit, not args.no_memory)
+            results["portfolios"].append(case)
+            os.remove(applications)
+            print_case(case)
+
+        applications = os.path.join(directory, 'applications_rules.txt')
+        generate_portfolio(applications, args.rule_rows, fuzzyVars, args.seed)
+        for count in parse_sizes(args.rules):
+            rules_file = os.path.join(directory, f'rules_{count}.txt')
+            generate_rules(rules_file, count, fuzzyRisks, fuzzyVars, args.seed)
+            case = run_case(applications, rules_file, args.rule_rows, args.process_limit, not args.no_memory)
+            results["rule_bases"].append(case)
+            print_case(case)
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print("Results saved in", args.output)
+
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            return 1
+        print(f"No regression above {args.threshold:.0%}")
+    return 0
+
+
+def print_case(case: dict) -> None:
+    timings = ", ".join(f"{name} {value:.3f}s" for name, value in case.items()
+                        if name not in ("rows", "rules", "peak_bytes", "process_peak_bytes")
+                        and not isinstance(value, dict))
+    memory = f", peak {case['peak_bytes'] / 2 ** 20:.1f} MiB" if "peak_bytes" in case else ""
+    if "process_peak_bytes" in case:
+        memory += f" (process {case['process_peak_bytes'] / 2 ** 20:.1f} MiB)"
+    print(f"rows {case['rows']}, rules {case['rules']}: {timings}{memory}")
+
+
+if __name__ == '__main__':
+    sys.exit(main_benchmarks())
@@ -1,11 +1,52 @@
-import matplotlib.pyplot as plt
-import skfuzzy as skf
+import argparse
+import numpy as np
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import zipfile
+from collections import deque
+from itertools import islice
+from typing import Iterable
 import MFIS_Classes as classes
 import MFIS_Read_Functions as loader
-import copy as cp
+import MFIS_Engine as engine
+import MFIS_Plots as plots
+
+# Methods timed when options["metrics"] is set, and the name of their stage
+METRIC_STAGES = {
+    "infer": "inference",
+    "_compute_antencedents": "antecedents",
+    "_compute_consequents": "consequents",
+    "_aggregation": "aggregation",
+    "_defuzzification": "defuzzification",
+    "_analytic_defuzzification": "defuzzification",
+    "infer_batch": "batch_inference",
+    "infer_configurations": "batch_inference",
+    "_batch_antecedents": "batch_antecedents",
+    "_batch_aggregation": "batch_aggregation",
+    "_batch_defuzzification": "batch_defuzzification",
+    "_analytic_batch": "batch_defuzzification",
+    "_sugeno": "sugeno",
+    "sweep": "sweep",
+}
+
+# matplotlib and skfuzzy are only imported by the methods that use them (plots
+# and the sampled defuzzification of single applications), so that scoring
+# runs start without loading them
+
+# Version of the snapshots written by save_snapshot, older ones are rebuilt
+SNAPSHOT_VERSION = 2
+
+# Every (consequents_mode, defuzz_mode) combination, see infer_configurations
+CONFIGURATIONS = [(consequents, method) for consequents in ('C', 'S')
+                  for method in ('centroid', 'bisector', 'mom', 'som', 'lom')]
 
 class FuzzySystem:
-    def __init__(self, fuzzyRisks: classes.FuzzySetsDict, fuzzyVars: classes.FuzzySetsDict, rules: classes.RuleList, options):
+    def __init__(self, fuzzyRisks: classes.FuzzySetsDict, fuzzyVars: classes.FuzzySetsDict, rules: classes.RuleList, options,
+                 compiled: engine.CompiledModel = None):
         self.fuzzyRisks = fuzzyRisks
         self.fuzzyVars = fuzzyVars
         self.fuzzySets: dict = self.fuzzyRisks.copy()
@@ -14,18 +55,183 @@ class FuzzySystem:
         self.rules = rules
         self.options = options
 
-        self.LINE_COLORS = ['g', 'y', 'r', 'k']
+        # Rules and sets resolved into index arrays, built by compile()
+        # (or already built: compiled, e.g. from a snapshot)
+        self.compiled: engine.CompiledModel = None
+        if compiled is not None:
+            self._compiled_at = self._versions()
+            self.compiled = compiled
+            self._buffers = threading.local()
+            self._model()
+        else:
+            self.compile()
+
+        # Number of applications each rule fired on, counted by process()
+        self.rules_applied = [0] * len(self.rules)
 
-    def process(self, applications: list[classes.Application], plot: list[str] = [], filename: str = None) -> None:
+        # Optional LRU cache of results, options["cache_size"] entries
+        self.cache: classes.ResultCache = None
+        if self.options.get("cache_size"):
+            self.cache = classes.ResultCache(self.options["cache_size"])
+
+        # Optional instrumentation, options["metrics"] True: the stages are
+        # wrapped here, so nothing is measured (or paid for) without it
+        self.metrics: classes.Metrics = None
+        if self.options.get("metrics"):
+            self.metrics = classes.Metrics()
+            for method, stage in METRIC_STAGES.items():
+                setattr(self, method, self.metrics.timed(stage, getattr(self, method)))
+
+    def compile(self) -> engine.CompiledModel:
+        # Called again automatically when the rules or the fuzzy sets change
+        parametric = self._membership_mode() == 'parametric'
+        self._compiled_at = self._versions()
+        self.compiled = engine.CompiledModel(self.fuzzyRisks, self.fuzzyVars, self.rules, parametric,
+                                             self._rule_index())
+        # Output buffers of _compute_consequents, one per thread
+        self._buffers = threading.local()
+        if getattr(self, "cache", None) is not None:
+            self.cache.invalidate()
+        return self.compiled
+
+    def use_model(self, compiled: engine.CompiledModel) -> None:
+        # Scores with compiled, a model built apart (e.g. a variant from
+        # engine.CompiledModel.with_trapezoids), until the sets or the rules
+        # of this system change
+        self._compiled_at = self._versions()
+        self.compiled = compiled
+        self._buffers = threading.local()
+        if getattr(self, "cache", None) is not None:
+            self.cache.invalidate()
+
+    def _versions(self) -> tuple:
+        # Versions of the containers the model is compiled from (replacing one
+        # is a change too)
+        return tuple((id(container), getattr(container, "version", 0))
+                     for container in (self.fuzzyRisks, self.fuzzyVars, self.rules))
+
+    def _model(self) -> engine.CompiledModel:
+        # Compiled model, rebuilt if a set or a rule changed since compile()
+        if self._compiled_at != self._versions() or \
+                self.compiled.parametric != (self._membership_mode() == 'parametric') or \
+                (self.compiled.index is not None) != self._rule_index():
+            self.compile()
+        return self.compiled
+
+    def save_snapshot(self, filename: str, source_hash: str = "") -> None:
+        # Saves the compiled model, the sets, the rules and the options in one
+        # npz file. source_hash: of the text files they were read from (see
+        # loader.sourceHash), so that from_files can tell a stale snapshot
+        sets = [
+            {"setid": setid, "var": fuzzySet.var, "label": fuzzySet.label, "xmin": fuzzySet.xmin,
+             "xmax": fuzzySet.xmax, "step": fuzzySet.step, "trapezoid": list(fuzzySet.trapezoid)}
+            for setid, fuzzySet in list(self.fuzzyRisks.items()) + list(self.fuzzyVars.items())
+        ]
+        metadata = {
+            "version": SNAPSHOT_VERSION,
+            "source_hash": source_hash,
+            "risks": len(self.fuzzyRisks),
+            "sets": sets,
+            "rules": [[rule.ruleName, rule.consequent] + list(rule.antecedent) for rule in self.rules],
+            "options": self.options,
+        }
+        # written next to it and renamed, so a reader never sees half a file
+        temporary = f"{filename}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as file:
+            np.savez(file, metadata=np.array(json.dumps(metadata)), **self._model().arrays())
+        os.replace(temporary, filename)
+
+    @classmethod
+    def load_snapshot(cls, filename: str, options=None, source_hash: str = None) -> "FuzzySystem":
+        # FuzzySystem saved by save_snapshot, without reading the text files
+        # nor compiling. options: the saved ones by default. ValueError if the
+        # snapshot is of another version or of other text files (source_hash)
+        with np.load(filename, allow_pickle=False) as snapshot:
+            metadata = json.loads(str(snapshot["metadata"]))
+            if metadata.get("version") != SNAPSHOT_VERSION:
+                raise ValueError(f"Snapshot version {metadata.get('version')}, expected {SNAPSHOT_VERSION}")
+            if source_hash is not None and metadata["source_hash"] != source_hash:
+                raise ValueError("Snapshot of other rules or fuzzy sets")
+            arrays = {name: snapshot[name] for name in snapshot.files if name != "metadata"}
+
+        fuzzyRisks, fuzzyVars = classes.FuzzySetsDict(), classes.FuzzySetsDict()
+        for i, saved in enumerate(metadata["sets"]):
+            fuzzySet = classes.FuzzySet()
+            fuzzySet.var = saved["var"]
+            fuzzySet.label = saved["label"]
+            fuzzySet.xmin = saved["xmin"]
+            fuzzySet.xmax = saved["xmax"]
+            fuzzySet.trapezoid = saved["trapezoid"]
+            fuzzySet.step = saved["step"]
+            (fuzzyRisks if i < metadata["risks"] else fuzzyVars)[saved["setid"]] = fuzzySet
+        rules = classes.RuleList()
+        for saved in metadata["rules"]:
+            rule = classes.Rule()
+            rule.ruleName = saved[0]
+            rule.consequent = saved[1]
+            rule.antecedent = saved[2:]
+            rules.append(rule)
+
+        options = metadata["options"] if options is None else options
+        compiled = engine.CompiledModel.from_arrays(arrays, bool(options.get("rule_index")))
+        return cls(fuzzyRisks, fuzzyVars, rules, options, compiled)
+
+    @classmethod
+    def from_files(cls, risksFile: str, varsFile: str, rulesFile: str, options, snapshot: str = None) -> "FuzzySystem":
+        # FuzzySystem of the text files, loaded from snapshot if it was saved
+        # from the same files. Otherwise (or if it does not exist) the files
+        # are read and compiled, and the snapshot is saved again
+        source_hash = loader.sourceHash([risksFile, varsFile, rulesFile])
+        if snapshot is not None and os.path.exists(snapshot):
+            try:
+                return cls.load_snapshot(snapshot, options, source_hash)
+            except (ValueError, KeyError, EOFError, zipfile.BadZipFile):
+                pass    # stale, truncated or not a snapshot: rebuilt below
+        fuzzySystem = cls(loader.readFuzzySetsFile(risksFile), loader.readFuzzySetsFile(varsFile),
+                          loader.readRulesFile(rulesFile), options)
+        if snapshot is not None:
+            fuzzySystem.save_snapshot(snapshot, source_hash)
+        return fuzzySystem
+
+    @property
+    def variables(self) -> list[str]:
+        # Column order of the matrices accepted by infer_batch
+        return self._model().variables
+
+    def process(self, applications: Iterable[classes.Application], plot: list[str] = [], filename: str = None,
+                chunk_size: int = 1000, workers: int = 1, exporter: plots.PlotExporter = None) -> None:
+        # applications can be any iterable (e.g. loader.iterApplicationsFile):
+        # they are scored as they come and the results are written every
+        # chunk_size applications, so memory does not depend on the input size.
+        # With workers > 1 the chunks are scored by a pool of processes.
+        # exporter: the aggregations of the applications in plot are written
+        # to files by it (see plot_exporter) instead of shown
+        start = time.perf_counter()
         file = open(filename, "w")
         self.rules_applied = [0] * len(self.rules)
-        for application in applications:
-            plot_application = False
-            if application.appId in plot:
-                plot_application = True
-
-            risk = fuzzySystem.inference(application, plot_application)
-            file.write(f"{application.appId}, Risk, {risk}\n")
+        if self.metrics is not None:
+            applications = self.metrics.timedIter("parsing", applications)
+        if workers > 1:
+            self._process_parallel(applications, plot, file, chunk_size, workers, exporter)
+        else:
+            lines = []
+            for application in applications:
+                plot_application = False
+                if application.appId in plot:
+                    plot_application = True
+
+                result = self.infer(application, plot_application)
+                self.count_rules(result.strengths)
+                if plot_application and result.aggregation is not None:
+                    if exporter is not None:
+                        exporter.aggregation(application.appId, *result.aggregation, result.risk)
+                    else:
+                        self._plot_aggregation(application.appId, result.aggregation, result.risk)
+                lines.append(f"{application.appId}, Risk, {result.risk}\n")
+                if len(lines) >= chunk_size:
+                    self._write_lines(file, lines)
+                    lines.clear()
+            self._write_lines(file, lines)
         
         if self.options["debug"]["rules_applied"]:
             K = 4
@@ -33,102 +239,424 @@ class FuzzySystem:
             print(f"Rules used more than {K}:", len([i for i in self.rules_applied if i > K]))
 
         file.close()
+        self._processed(start)
+        self.render()
+
+    def _write_lines(self, file, lines: list[str]) -> None:
+        if self.metrics is not None:
+            with self.metrics.timer("output"):
+                file.writelines(lines)
+            self.metrics.applications += len(lines)
+        else:
+            file.writelines(lines)
+
+    def _processed(self, start: float) -> None:
+        # Records a whole process/process_arrays run in the metrics
+        if self.metrics is not None:
+            self.metrics.record("process", time.perf_counter() - start)
+
+    def _process_parallel(self, applications: Iterable[classes.Application], plot: list[str], file,
+                          chunk_size: int, workers: int, exporter: plots.PlotExporter = None) -> None:
+        def sources():
+            applications_left = iter(applications)
+            while True:
+                chunk = list(islice(applications_left, chunk_size))
+                if not chunk:
+                    break
+                yield 'rows', [application.appId for application in chunk], self.application_matrix(chunk)
+
+        self._score_parallel(sources(), file, workers, plot=plot, exporter=exporter)
+
+    def _score_parallel(self, sources: Iterable[tuple], output, workers: int,
+                        configurations: list[tuple] = None, plot: list[str] = (),
+                        exporter: plots.PlotExporter = None) -> None:
+        # sources: chunks as sent to the workers (see _chunk_inputs).
+        # Every worker builds its own FuzzySystem once, then reads, scores and
+        # formats the chunks sent to it: the parent only writes what comes
+        # back. At most 2 chunks per worker are pending, and they are written
+        # in their original order, the aggregations of the rows in plot with them
+        initargs = (self.fuzzyRisks, self.fuzzyVars, self.rules, self.options, self._model())
+        binary = isinstance(output, loader.BinaryWriter)
+        with multiprocessing.Pool(workers, _init_worker, initargs) as pool:
+            pending = deque()
+            for source in sources:
+                pending.append(pool.apply_async(_score_chunk, (source, configurations, plot, binary)))
+                while len(pending) > 2 * workers:
+                    self._write_chunk(output, pending.popleft(), exporter)
+            while pending:
+                self._write_chunk(output, pending.popleft(), exporter)
+
+    def _chunk_inputs(self, source: tuple) -> tuple:
+        # (appIds, input matrix) of a chunk of a worker: ('rows', appIds,
+        # matrix), ('array', structured array), ('text', filename, start, stop)
+        # bytes of a text file (loader.iterTextRanges) or ('binary', filename,
+        # start, stop) records of a binary file
+        kind = source[0]
+        if kind == 'rows':
+            return source[1], source[2]
+        if kind == 'text':
+            array = loader.readApplicationsRange(*source[1:], self.variables, self._input_dtype())
+        elif kind == 'binary':
+            array = loader.readBinaryFile(source[1])[source[2]:source[3]]
+        else:
+            array = source[1]
+        return array['appId'].astype(str), self.application_matrix(array)
+
+    def process_file(self, inputFile: str, filename: str, workers: int = 1, chunk_size: int = 100000,
+                     binary: bool = False, configurations: list[tuple] = None, plot: list[str] = (),
+                     exporter: plots.PlotExporter = None) -> None:
+        # Scores a whole applications file, text or binary (.bin), as
+        # process_arrays. With workers > 1 the file is only split here, into
+        # byte ranges of about chunk_size lines (or ranges of records): every
+        # worker reads, parses, scores and formats its chunks, so the parent
+        # only writes them
+        if workers <= 1:
+            if inputFile.endswith('.bin'):
+                chunks = loader.iterBinaryArrays(inputFile, chunk_size)
+            else:
+                chunks = loader.iterApplicationsArrays(inputFile, self.variables, chunk_size, self._input_dtype())
+            self.process_arrays(chunks, filename, binary=binary, configurations=configurations,
+                                plot=plot, exporter=exporter)
+            return
+        start = time.perf_counter()
+        if inputFile.endswith('.bin'):
+            with open(inputFile, 'rb') as file:
+                _, count, _ = loader.readBinaryHeader(file)
+            sources = (('binary', inputFile, first, min(first + chunk_size, count))
+                       for first in range(0, count, chunk_size))
+        else:
+            sources = (('text', inputFile, first, stop) for first, stop in loader.iterTextRanges(inputFile, chunk_size))
+        output = loader.BinaryWriter(filename) if binary else open(filename, "w")
+        self.rules_applied = [0] * len(self.rules)
+        self._score_parallel(sources, output, workers, configurations, plot, exporter)
+        output.close()
+        self._processed(start)
         self.render()
 
+    def process_arrays(self, chunks: Iterable[np.ndarray], filename: str, workers: int = 1,
+                       binary: bool = False, configurations: list[tuple] = None,
+                       plot: list[str] = (), exporter: plots.PlotExporter = None) -> None:
+        # Columnar version of process: chunks are structured arrays (e.g. from
+        # loader.iterApplicationsArrays or loader.iterBinaryArrays), scored with
+        # infer_batch and written chunk by chunk, without any Application object.
+        # binary: results written in the binary format (loader.BinaryWriter)
+        # configurations: scored with infer_configurations instead, one
+        # "appId, C-centroid, risk, C-bisector, risk, ..." row per application
+        # plot, exporter: the aggregations of these appIds are written to files
+        # by exporter (see plot_exporter), or shown without it
+        # (see process_file to also parse a file in the workers)
+        start = time.perf_counter()
+        output = loader.BinaryWriter(filename) if binary else open(filename, "w")
+        self.rules_applied = [0] * len(self.rules)
+        if self.metrics is not None:
+            chunks = self.metrics.timedIter("parsing", chunks)
+        if workers > 1:
+            self._score_parallel((('array', chunk) for chunk in chunks), output, workers, configurations,
+                                 plot, exporter)
+        else:
+            for chunk in chunks:
+                appIds, matrix = self._chunk_inputs(('array', chunk))
+                risks, plotted = self._score_arrays(appIds, matrix, configurations, plot, self.rules_applied)
+                self._plot_rows(plotted, exporter)
+                self._write_results(output, appIds, risks)
+        output.close()
+        self._processed(start)
+        self.render()
+
+    def _score_arrays(self, appIds, matrix: np.ndarray, configurations: list[tuple] = None,
+                      plot: list[str] = (), rules_applied: list[int] = None) -> tuple:
+        # Risks of a chunk (infer_batch, or infer_configurations with
+        # configurations), and (appId, x, aggregation, risk) of its rows whose
+        # appId is in plot, from the similarities of this same scoring (none
+        # for sugeno, which has no aggregation)
+        rows = np.flatnonzero(np.isin(np.asarray(appIds), list(plot))) if plot else []
+        if not len(rows) or self._consequents_method() == 'sugeno':
+            if configurations is not None:
+                return self.infer_configurations(matrix, configurations, rules_applied), []
+            return self.infer_batch(matrix, rules_applied), []
+        self._model()
+        strengths, similarities = self._batch_antecedents(matrix)
+        if rules_applied is not None:
+            for i, count in enumerate(np.count_nonzero(strengths, axis=0)):
+                rules_applied[i] += int(count)
+        if configurations is not None:
+            risks = self._configuration_rows(matrix, strengths, similarities, configurations)
+            plotted = self._defuzz_rows(matrix[rows], strengths[rows], similarities[rows])
+        else:
+            risks = self._defuzz_rows(matrix, strengths, similarities)
+            plotted = risks[rows]
+        x, aggregation = self._batch_aggregation(similarities[rows])
+        return risks, [(str(appIds[row]), x, aggregation[i], plotted[i]) for i, row in enumerate(rows)]
+
+    def _plot_rows(self, plotted: list[tuple], exporter: plots.PlotExporter = None) -> None:
+        # Hands the aggregations of the plotted rows (see _score_arrays) to
+        # exporter, or draws them without it
+        for appId, x, aggregation, risk in plotted:
+            if exporter is not None:
+                exporter.aggregation(appId, x, aggregation, risk)
+            else:
+                self._plot_aggregation(appId, (x, aggregation), risk)
+
+    def plot_exporter(self, directory: str, format: str = 'png', workers: int = 2,
+                      fuzzysets: bool = True) -> plots.PlotExporter:
+        # Headless exporter of the figures of this system (Agg backend) to
+        # directory, for process/process_arrays. fuzzysets: also write the
+        # figure of all the fuzzy sets. Close it to wait for the files
+        riskSets = [(label, fuzzySet.x, fuzzySet.y) for label, fuzzySet in self.fuzzyRisks.items()]
+        exporter = plots.PlotExporter(directory, riskSets, self.options["defuzz_mode"], format, workers)
+        if fuzzysets:
+            exporter.fuzzysets(self._plotted_sets())
+        return exporter
+
+    def _write_chunk(self, output, task, exporter: plots.PlotExporter = None) -> None:
+        formatted, count, rules_applied, stages, plotted = task.get()
+        self.merge_rules_applied(rules_applied)
+        if self.metrics is not None and stages:
+            self.metrics.merge(stages)
+        self._plot_rows(plotted, exporter)
+        self._write_formatted(output, formatted, count)
+
+    def _write_results(self, output, appIds: list[str], risks) -> None:
+        # risks: one per application, or one column per configuration
+        binary = isinstance(output, loader.BinaryWriter)
+        self._write_formatted(output, self._format_results(appIds, risks, binary), len(appIds))
+
+    def _format_results(self, appIds, risks, binary: bool = False):
+        # Results of a chunk as written: text lines, or the bytes of its
+        # binary records and their dtype (see loader.BinaryWriter.writeRecords)
+        if binary:
+            records = loader.resultsArray(appIds, risks)
+            dtype = loader.binaryDtype(records.dtype)
+            return records.astype(dtype).tobytes(), dtype
+        if risks.dtype.names:
+            line = "{}" + "".join(f", {name}, {{}}" for name in risks.dtype.names) + "\n"
+            columns = [risks[name].tolist() for name in risks.dtype.names]
+            return "".join([line.format(*row) for row in zip(appIds, *columns)])
+        return "".join([f"{appId}, Risk, {risk}\n" for appId, risk in zip(appIds, risks.tolist())])
+
+    def _write_formatted(self, output, formatted, count: int) -> None:
+        # formatted: of _format_results, for count applications
+        start = time.perf_counter()
+        if isinstance(output, loader.BinaryWriter):
+            output.writeRecords(*formatted)
+        else:
+            output.write(formatted)
+        if self.metrics is not None:
+            self.metrics.record("output", time.perf_counter() - start)
+            self.metrics.applications += count
+
+    def count_rules(self, strengths) -> None:
+        # Adds to rules_applied the rules that fired in one InferenceResult
+        for i, strength in enumerate(strengths):
+            if strength:
+                self.rules_applied[i] += 1
+
+    def merge_rules_applied(self, rules_applied: list[int]) -> None:
+        # Adds counters kept apart (per worker or per thread) to rules_applied
+        for i, count in enumerate(rules_applied):
+            self.rules_applied[i] += count
+
+    def application_matrix(self, applications) -> np.ndarray:
+        # N x len(self.variables) input matrix of infer_batch, from a list of
+        # Applications or a structured array of loader.readApplicationsArray
+        if isinstance(applications, np.ndarray) and applications.dtype.names:
+            return self._inputs(loader.applicationsMatrix(applications, self.variables))
+        variables = self.variables
+        rows = []
+        for application in applications:
+            data = dict(application.data)
+            rows.append([data[variable] for variable in variables])
+        return self._inputs(rows).reshape(-1, len(variables))
+
+    def export_metrics(self, format: str = 'json') -> str:
+        # Metrics (options["metrics"]) with the rules_applied of the last
+        # process, as JSON or in the Prometheus text format
+        if self.metrics is None:
+            raise ValueError('Metrics are disabled, set options["metrics"]')
+        rules = {rule.ruleName: count for rule, count in zip(self.rules, self.rules_applied)}
+        if format.lower() == 'prometheus':
+            return self.metrics.toPrometheus(rules)
+        return self.metrics.toJSON(rules)
+
 # Fuzzy methods ______________________________________________
 
     def inference(self, application: classes.Application, plot: bool = False) -> float:
+        result = self.infer(application, plot)
+        if plot and result.aggregation is not None:
+            self._plot_aggregation(application.appId, result.aggregation, result.risk)  
+
+        return result.risk
+
+    def infer(self, application: classes.Application, aggregation: bool = False) -> classes.InferenceResult:
         # computation of antecedent: max of min
         # computation of consequent: clip or scale
         # aggregation: max (union of consequents)
         # defuzzification: centroid of area, bisector, mean of max, smallest of max, largest of max
+        # (consequents_mode 'sugeno': weighted average of the rule outputs instead,
+        # no aggregation is computed)
+        # Nothing of the FuzzySystem, its rules or sets is modified, so several
+        # threads can share it: the rule strengths come back in the result
+        # (aggregation: also keep it with the analytic defuzzification)
 
         # dict = {variable : value}
         applicationData = {}
         for variable, value in application.data:
             applicationData[variable] = value
 
-        similarities = self._compute_antencedents(applicationData)
-        risks = self._compute_consequents(similarities)
-        aggregation = self._aggregation(risks)
-        defuzz = self._defuzzification(aggregation)     
-        if plot:
-            self._plot_aggregation(application, aggregation, defuzz)  
-
-        return defuzz
+        if self.cache is not None:
+            key = self._cache_key([applicationData[variable] for variable in self._model().variables])
+            cached = self.cache.lookup(key)
+            if cached is not None:
+                return self._cached_result(cached, application.appId, aggregation)
+
+        result = classes.InferenceResult()
+        result.appId = application.appId
+        result.strengths, result.similarities = self._compute_antencedents(applicationData)
+        if self._consequents_method() == 'sugeno':
+            row = self.input_row(applicationData)[None, :]
+            result.risk = self._sugeno(row, result.strengths[None, :])[0]
+        elif self._defuzz_engine() == 'analytic':
+            result.risk = self._analytic_defuzzification(result.similarities)
+            if aggregation:
+                result.aggregation = self._aggregation(self._compute_consequents(result.similarities))
+        else:
+            risks = self._compute_consequents(result.similarities)
+            result.aggregation = self._aggregation(risks)
+            result.risk = self._defuzzification(result.aggregation)
+
+        if self.cache is not None:
+            self.cache.store(key, result)
+        return result
+
+    def _cache_key(self, values) -> tuple:
+        # Input vector in variables order plus the options that change the result
+        key = (self._consequents_method(), self._defuzz_method(), self._defuzz_engine(), self._membership_mode())
+        if key[0] == 'sugeno':
+            key += (repr(self.options.get("sugeno_consequents")),)
+        return key + tuple(values)
+
+    def _cached_result(self, cached: classes.InferenceResult, appId: str, aggregation: bool) -> classes.InferenceResult:
+        # Copy of a cached result for another application (the cached one is shared)
+        result = classes.InferenceResult()
+        result.appId = appId
+        result.risk = cached.risk
+        result.strengths = cached.strengths
+        result.similarities = cached.similarities
+        result.aggregation = cached.aggregation
+        if aggregation and result.aggregation is None and self._consequents_method() != 'sugeno':
+            result.aggregation = self._aggregation(self._compute_consequents(result.similarities))
+        return result
     
 
-    def _compute_antencedents(self, applicationData: dict) -> list[classes.Rule]:
-        # Create a dictionary of similarities
-        similarity = {}
-        for label in self.fuzzyRisks:
-            similarity[label] = []
-            
-        # Compute the strength of each rule
-        for i, rule in enumerate(self.rules):
-            # Evaluate the strength of each antecedent of the rule
-            strengths: list[float] = []
-            for antecedent in rule.antecedent :
-                value = applicationData[antecedent.split("=")[0]]
-                if value < 0:
-                    strengths.append(self.fuzzySets[antecedent].y[0])
-                elif len(self.fuzzySets[antecedent].y) <= value:
-                    strengths.append(self.fuzzySets[antecedent].y[-1])
-                else:
-                    strengths.append(self.fuzzySets[antecedent].y[value])
-
-            # Compute the strength of the rule
-            rule.strength = min(strengths)
-            if rule.strength:
-                label = rule.consequent
-                self.rules_applied[i] += 1
-                similarity[label].append(rule.strength)
-
-        # Obtain the maximum strength/similarity for each consequent
-        for label in similarity:
-            if similarity[label]:
-                similarity[label] = max(similarity[label])
-            else:
-                similarity[label] = 0
+    def _compute_antencedents(self, applicationData: dict):
+        # returns the strength of every rule and the similarity of every consequent
+        model = self._model()
 
-        return similarity
+        # Compute the strength of each rule on the compiled tables
+        row = self.input_row(applicationData)[None, :]
+        strengths = model.strengths(row)
 
-
-    def _compute_consequents(self, similarities: dict) -> dict:
-        risks = cp.deepcopy(self.fuzzyRisks)
-        method = self.options["consequents_mode"] if self.options["consequents_mode"] else 'C'
-
-       
-        if method == 'C' or method.lower() == 'clip':
-            for label in risks:
-                risks[label].y = [
-                    min(similarities[label], risks[label].y[i]) 
-                    for i in range(len(risks[label].y))
-                ]
-        elif method == 'S' or method.lower() == 'scale':
-            for label in risks:
-                risks[label].y = [
-                    similarities[label] * risks[label].y[i] 
-                    for i in range(len(risks[label].y))
-                ]        
-
-        return risks
+        # Obtain the maximum strength/similarity for each consequent
+        maximums = model.similarities(strengths)[0]
+        similarity = {}
+        for i, label in enumerate(model.labels):
+            similarity[label] = maximums[i]
+
+        return strengths[0], similarity
+
+
+    def _compute_consequents(self, similarities: dict) -> np.ndarray:
+        # Clipped/scaled risk sets (labels x M), written into the preallocated
+        # buffer: the risk FuzzySets are never copied
+        model = self.compiled
+        similarity = np.array([[similarities[label] for label in model.labels]], dtype=float)
+        buffer = getattr(self._buffers, "consequents", None)
+        if buffer is None:
+            buffer = self._buffers.consequents = np.empty((1,) + model.risk_y.shape)
+        engine.consequents(similarity, model.risk_y, self._consequents_method(), out=buffer)
+        return buffer[0]
     
-    def _aggregation(self, consequents: dict):
-        # https://pythonhosted.org/scikit-fuzzy/api/skfuzzy.html#skfuzzy.fuzzy_min
-        
-        fuzzySets = [consequents[label] for label in consequents]
-        output = skf.fuzzy_or(fuzzySets[0].x, fuzzySets[0].y, fuzzySets[1].x, fuzzySets[1].y)
-        output = skf.fuzzy_or(output[0], output[1], fuzzySets[2].x, fuzzySets[2].y)
-        
-        return output
+    def _aggregation(self, consequents: np.ndarray):
+        # Union of any number of consequents, all of them on the same universe
+        return self.compiled.risk_x, engine.aggregation(consequents)
 
     # https://pythonhosted.org/scikit-fuzzy/auto_examples/plot_defuzzify.html
     def _defuzzification(self, aggregation) -> float:
         x = aggregation[0]
         y = aggregation[1]
 
-        method = self.options["defuzz_mode"] if self.options["defuzz_mode"] else 'centroid'
+        import skfuzzy as skf
+        try:
+            defuzz = skf.defuzz(x, y, self._defuzz_method())
+        except skf.defuzzify.EmptyMembershipError:
+            # no rule fired: no area for centroid/bisector, NaN as in the batch kernels
+            defuzz = np.nan
+        return defuzz
+
+    def _analytic_defuzzification(self, similarities: dict) -> float:
+        # Exact defuzzification on the trapezoids of the risk sets, no grid
+        model = self.compiled
+        similarity = np.array([[similarities[label] for label in model.labels]], dtype=float)
+        return self._analytic_risks(similarity)[0]
+
+    def _consequents_method(self, method: str = None) -> str:
+        # method: the one of a configuration, options["consequents_mode"] by default
+        method = method or self.options["consequents_mode"] or 'C'
+        if method == 'C' or method.lower() == 'clip':
+            return 'C'
+        elif method == 'S' or method.lower() == 'scale':
+            return 'S'
+        elif method.lower() in ('sugeno', 'ts', 'takagi-sugeno'):
+            return 'sugeno'
+        return method
+
+    def _membership_mode(self) -> str:
+        # 'table': integer inputs looked up in the sampled sets,
+        # 'parametric': float inputs evaluated on the trapezoids
+        mode = self.options.get("membership_mode") or 'table'
+        return mode.lower()
+
+    def _rule_index(self) -> bool:
+        # True: only the rules that can fire for an input are evaluated (see
+        # engine.RuleIndex), worth it for large rule bases
+        return bool(self.options.get("rule_index"))
+
+    def _input_dtype(self):
+        return np.float64 if self._model().parametric else np.int64
+
+    def _inputs(self, values) -> np.ndarray:
+        # values (array-like) as inputs of the compiled model. The tables of the
+        # table membership_mode are indexed by integers: other values raise
+        # ValueError instead of being truncated (use membership_mode 'parametric')
+        dtype = self._input_dtype()
+        values = np.asarray(values)
+        if values.dtype.kind in 'iub' or (dtype is np.float64 and values.dtype.kind == 'f'):
+            return values.astype(dtype, copy=False)
+        numbers = values.astype(np.float64)
+        if dtype is np.int64 and not (np.isfinite(numbers) & (numbers == np.trunc(numbers))).all():
+            raise ValueError("Non-integer input in the table membership_mode, use membership_mode 'parametric'")
+        return numbers.astype(dtype, copy=False)
+
+    def input_row(self, data: dict) -> np.ndarray:
+        # Input row of one application {variable: value}, in the order of
+        # self.variables. KeyError for a missing variable, ValueError for a
+        # value that is not one finite number (an integer in the table
+        # membership_mode)
+        variables = self._model().variables
+        row = self._inputs([data[variable] for variable in variables])
+        if row.shape != (len(variables),):
+            raise ValueError("One number per variable expected")
+        if row.dtype.kind == 'f' and not np.isfinite(row).all():
+            raise ValueError("Non-finite input")
+        return row
+
+    def _defuzz_engine(self) -> str:
+        # 'sampled': skfuzzy on the grid of the risk sets, 'analytic': exact trapezoids
+        engine = self.options.get("defuzz_engine") or 'sampled'
+        return engine.lower()
+
+    def _defuzz_method(self, method: str = None) -> str:
+        method = method or self.options["defuzz_mode"] or 'centroid'
         if method.lower() == 'coa' or method.lower() == 'centroid of area':
             method = 'centroid'
         elif method.lower() == 'boa' or method.lower() == 'bisector of area':
@@ -139,97 +667,242 @@ class FuzzySystem:
             method = 'som'
         elif method.lower() == 'largest of maximum':
             method = 'lom'
-        
-        defuzz = skf.defuzz(x, y, method)
-        return defuzz
+        return method.lower()
+
+# Batch methods ______________________________________________
+
+    def infer_batch(self, matrix, rules_applied: list[int] = None, cache: bool = True) -> np.ndarray:
+        # Same pipeline as inference, for N applications at once.
+        # matrix: N x len(self.variables) integers (floats in parametric
+        # membership_mode), columns in self.variables order
+        # rules_applied: if given, the number of rows each rule fired on is added to it
+        # cache: False to bypass the result cache (e.g. for one-off sweeps)
+        # returns the N defuzzified risks (NaN where centroid/bisector has no area)
+        # (or a structured array with a column per variable, see loader.readApplicationsArray)
+        model = self._model()
+        if isinstance(matrix, np.ndarray) and matrix.dtype.names:
+            matrix = self.application_matrix(matrix)
+        matrix = self._inputs(matrix).reshape(-1, len(model.variables))
+        if self.cache is not None and cache:
+            return self._infer_batch_cached(matrix, rules_applied)
+
+        risks, strengths, _ = self._infer_rows(matrix)
+        if rules_applied is not None:
+            for i, count in enumerate(np.count_nonzero(strengths, axis=0)):
+                rules_applied[i] += int(count)
+        return risks
+
+    def _infer_rows(self, matrix: np.ndarray):
+        # risks, strengths (N x rules) and similarities (N x labels) of every row
+        strengths, similarities = self._batch_antecedents(matrix)
+        return self._defuzz_rows(matrix, strengths, similarities), strengths, similarities
+
+    def _defuzz_rows(self, matrix: np.ndarray, strengths: np.ndarray, similarities: np.ndarray) -> np.ndarray:
+        # risks of the rows of matrix from their rule strengths
+        if self._consequents_method() == 'sugeno':
+            return self._sugeno(matrix, strengths)
+        if self._defuzz_engine() == 'analytic':
+            return self._analytic_batch(similarities)
+        x, aggregation = self._batch_aggregation(similarities)
+        return self._batch_defuzzification(x, aggregation)
+
+    def _batch_antecedents(self, matrix: np.ndarray):
+        model = self.compiled
+        strengths = model.strengths(matrix)
+        return strengths, model.similarities(strengths)
+
+    def _infer_batch_cached(self, matrix: np.ndarray, rules_applied: list[int]) -> np.ndarray:
+        # Only the distinct rows are looked up, those not found are scored
+        # together and stored. The key of a row is its bytes after the options
+        # (apart from the keys of inference), its entry the kind of the risks
+        # ('i' or 'f', as scored), the risk (8 bytes) and a bitmask of the
+        # rules fired, in bytes too: nothing per row for the garbage
+        # collector, and the entries are decoded all at once
+        rows, inverse = engine.unique_rows(matrix)
+        rows = np.ascontiguousarray(rows)
+        prefix = repr(self._cache_key(())).encode()
+        keys = [prefix + row for row in rows.view(np.dtype((np.void, rows.strides[0]))).ravel().tolist()]
+        entries = self.cache.lookupMany(keys)
+
+        missing = [j for j, entry in enumerate(entries) if entry is None]
+        if missing:
+            risks, strengths, _ = self._infer_rows(rows[missing])
+            kind = 'i' if risks.dtype.kind in 'iu' else 'f'
+            risks = risks.astype(np.int64 if kind == 'i' else np.float64)
+            scored = np.concatenate([np.full((len(missing), 1), ord(kind), dtype=np.uint8),
+                                     risks.view(np.uint8).reshape(len(missing), -1),
+                                     np.packbits(strengths != 0, axis=1)], axis=1)
+            scored = scored.view(np.dtype((np.void, scored.shape[1]))).ravel().tolist()
+            self.cache.storeMany([keys[j] for j in missing], scored)
+            for j, entry in zip(missing, scored):
+                entries[j] = entry
+
+        n_rules = len(self.compiled.consequents)
+        entries = np.frombuffer(b"".join(entries), dtype=np.uint8).reshape(len(rows), 9 + (n_rules + 7) // 8)
+        kind = chr(entries[0, 0]) if len(entries) else 'f'
+        risks = entries[:, 1:9].copy().view(np.int64 if kind == 'i' else np.float64).reshape(-1)
+        if rules_applied is not None:
+            # every row fired the rules of its entry, once per occurrence
+            fired = np.unpackbits(entries[:, 9:], axis=1, count=n_rules)
+            counts = np.bincount(inverse, minlength=len(rows)) @ fired
+            for i, count in enumerate(counts):
+                rules_applied[i] += int(count)
+        return risks[inverse]
+
+    def infer_configurations(self, matrix, configurations: list[tuple] = None,
+                             rules_applied: list[int] = None) -> np.ndarray:
+        # Scores the applications of matrix (as in infer_batch) under several
+        # (consequents_mode, defuzz_mode) configurations, all of them
+        # (CONFIGURATIONS) by default. The strengths are computed once, the
+        # consequents and their aggregation once per consequents_mode, and only
+        # the defuzzification once per configuration
+        # returns a structured array with one column per configuration, named
+        # "<C|S>-<defuzz method>" (e.g. "S-som"), or "sugeno"
+        model = self._model()
+        if isinstance(matrix, np.ndarray) and matrix.dtype.names:
+            matrix = self.application_matrix(matrix)
+        matrix = self._inputs(matrix).reshape(-1, len(model.variables))
+        strengths, similarities = self._batch_antecedents(matrix)
+        if rules_applied is not None:
+            for i, count in enumerate(np.count_nonzero(strengths, axis=0)):
+                rules_applied[i] += int(count)
+        return self._configuration_rows(matrix, strengths, similarities, configurations)
+
+    def _configuration_rows(self, matrix: np.ndarray, strengths: np.ndarray, similarities: np.ndarray,
+                            configurations: list[tuple] = None) -> np.ndarray:
+        # risks of the rows of matrix under every configuration, from their
+        # rule strengths (see infer_configurations)
+        model = self.compiled
+        configurations = [(self._consequents_method(consequents), self._defuzz_method(method))
+                          for consequents, method in (configurations or CONFIGURATIONS)]
+        columns = {}
+        for consequents in dict.fromkeys(consequents for consequents, _ in configurations):
+            if consequents == 'sugeno':
+                columns['sugeno'] = self._sugeno(matrix, strengths)
+                continue
+            if self._defuzz_engine() == 'analytic':
+                if model.risk_trapezoids is None:
+                    raise ValueError("Analytic defuzzification needs the trapezoid of every risk set")
+                x, y = engine.trapezoid_aggregation(similarities, model.risk_trapezoids,
+                                                    model.risk_x[0], model.risk_x[-1], consequents)
+                kernel = engine.analytic_defuzz_points
+            else:
+                x = model.risk_x
+                y = engine.aggregation(engine.consequents(similarities, model.risk_y, consequents))
+                kernel = engine.defuzz
+            for method in [method for other, method in configurations if other == consequents]:
+                columns[f"{consequents}-{method}"] = kernel(x, y, method)
+
+        names = list(dict.fromkeys('sugeno' if consequents == 'sugeno' else f"{consequents}-{method}"
+                                   for consequents, method in configurations))
+        risks = np.empty(matrix.shape[0], dtype=[(name, columns[name].dtype) for name in names])
+        for name in names:
+            risks[name] = columns[name]
+        return risks
+
+    def sweep(self, application, axes: dict, rules_applied: list[int] = None) -> np.ndarray:
+        # What-if response of one application: its risk when the variables of
+        # axes ({variable: values}, usually one or two) take every combination
+        # of their values, the rest keeping those of application (an
+        # Application or {variable: value}).
+        # The antecedents on the fixed variables are evaluated once, and only
+        # those on the swept variables over their values (see
+        # engine.CompiledModel.sweep_strengths)
+        # returns len(values of the 1st variable) x len(values of the 2nd) ... risks
+        model = self._model()
+        data = dict(application.data) if isinstance(application, classes.Application) else application
+        base = self._inputs([data[variable] for variable in model.variables])
+        columns = [model.variables.index(variable) for variable in axes]
+        grids = [self._inputs(values).reshape(-1) for values in axes.values()]
+        shape = tuple(len(grid) for grid in grids)
+
+        strengths = model.sweep_strengths(base, columns, grids).reshape(-1, len(model.consequents))
+        if rules_applied is not None:
+            for i, count in enumerate(np.count_nonzero(strengths, axis=0)):
+                rules_applied[i] += int(count)
+        matrix = np.repeat(base[None, :], strengths.shape[0], axis=0)
+        if self._consequents_method() == 'sugeno':
+            # only the linear consequents read the swept inputs
+            coordinates = np.unravel_index(np.arange(strengths.shape[0]), shape)
+            for column, grid, index in zip(columns, grids, coordinates):
+                matrix[:, column] = grid[index]
+        return self._defuzz_rows(matrix, strengths, model.similarities(strengths)).reshape(shape)
+
+    def _sugeno(self, matrix: np.ndarray, strengths: np.ndarray) -> np.ndarray:
+        # Zero-order Takagi-Sugeno: average of the output of every rule weighted
+        # by its strength (NaN if no rule fired). The output of a label is the
+        # centroid of its risk set, or options["sugeno_consequents"][label]:
+        # a number, or {"constant": p0, variable: coefficient, ...} for a
+        # linear function of the inputs
+        model = self.compiled
+        overrides = self.options.get("sugeno_consequents")
+        if not overrides:
+            return engine.sugeno(strengths, model.consequents, model.risk_centroids)
+        constants = model.risk_centroids.copy()
+        coefficients = np.zeros((len(model.labels), len(model.variables)))
+        for label, consequent in overrides.items():
+            i = model.labels.index(label)
+            if isinstance(consequent, dict):
+                constants[i] = consequent.get("constant", 0)
+                for variable, coefficient in consequent.items():
+                    if variable != "constant":
+                        coefficients[i, model.variables.index(variable)] = coefficient
+            else:
+                constants[i] = consequent
+        outputs = constants + matrix @ coefficients.T if coefficients.any() else constants
+        return engine.sugeno(strengths, model.consequents, outputs)
+
+    def _analytic_batch(self, similarities: np.ndarray) -> np.ndarray:
+        return self._analytic_risks(similarities)
+
+    def _analytic_risks(self, similarities: np.ndarray) -> np.ndarray:
+        # (not timed, shared by _analytic_batch and _analytic_defuzzification,
+        # each measured under its own stage)
+        model = self.compiled
+        if model.risk_trapezoids is None:
+            raise ValueError("Analytic defuzzification needs the trapezoid of every risk set")
+        return engine.analytic_defuzz(
+            similarities, model.risk_trapezoids, model.risk_x[0], model.risk_x[-1],
+            self._consequents_method(), self._defuzz_method()
+        )
+
+    def _batch_aggregation(self, similarities: np.ndarray):
+        model = self.compiled
+        risks = engine.consequents(similarities, model.risk_y, self._consequents_method())
+        return model.risk_x, engine.aggregation(risks)
+
+    def _batch_defuzzification(self, x: np.ndarray, aggregation: np.ndarray) -> np.ndarray:
+        return engine.defuzz(x, aggregation, self._defuzz_method())
         
 
 # Plot methods ______________________________________________
 
     def plot_fuzzysets(self) -> None:
-        # Constants        
-        self.VARS = ['Age', 'IncomeLevel', 'Assets', 'Amount', 'Job', 'History', 'Risk']
-        self.PLOT_ROWS = 2
-        self.PLOT_COLS = 4
-
-        # Create plot
-        self.fig, self.axis = plt.subplots(self.PLOT_ROWS, self.PLOT_COLS, figsize=(12, 5))
-        self.fig.subplots_adjust(left=0.1, right=0.95, bottom=0.1, top=0.9, wspace=0.4, hspace=0.3)
-        self.fig.suptitle("Fuzzy Sets", fontsize=16)
-        # self.axis.set_aspect('equal')
-
-        # Create special axis for Risk
-        gs = self.axis[0, -1].get_gridspec()
-        for ax in self.axis[0:, -1]:
-            ax.remove()
-        self.axRisk = self.fig.add_subplot(gs[0:, -1])
-
-        # Create graphs data structures
-        self.graphs = [[] for _ in range(len(self.VARS))]
-        self.counts = [0] * len(self.VARS)
-        self.labels = [[] for _ in range(len(self.VARS))]
-
-        # Plots graph for each fuzzy set in the dictionary
-        for fuzzySet in self.fuzzySets:
-            i = self.VARS.index(self.fuzzySets[fuzzySet].var)
-            if i == 6:
-                graph = self.axRisk.plot(
-                    self.fuzzySets[fuzzySet].x, 
-                    self.fuzzySets[fuzzySet].y,    
-                    f"-{self.LINE_COLORS[self.counts[i]]}",
-                    label=self.fuzzySets[fuzzySet].label
-                )
-            else:
-                graph = self.axis[i%self.PLOT_ROWS][i//self.PLOT_ROWS].plot(
-                    self.fuzzySets[fuzzySet].x, 
-                    self.fuzzySets[fuzzySet].y,    
-                    f"-{self.LINE_COLORS[self.counts[i]]}",
-                    label=self.fuzzySets[fuzzySet].label
-                )
-
-            self.graphs[i].append(graph)
-            self.labels[i].append(self.fuzzySets[fuzzySet].label)
-            self.counts[i] += 1
-
-        # Set graph labels and legends
-        for i in range(0, 6):
-            ax = self.axis[i%self.PLOT_ROWS][i//self.PLOT_ROWS]
-            ax.set_xlabel(self.VARS[i])
-            ax.set_ylabel("Membership degree")
-            ax.legend(self.labels[i], loc='lower right', fontsize='xx-small')
-
-        self.axRisk.set_xlabel(self.VARS[6])
-        self.axRisk.set_ylabel("Membership degree")
-        self.axRisk.legend(self.labels[6], loc='lower right', fontsize='xx-small')
-
-
-    def _plot_aggregation(self, application: classes.Application, aggregation, defuzz: int) -> None:
-        fig, ax = plt.subplots()
-        fig.suptitle(f"Inference of application {application.appId}")
-        fig.subplots_adjust(left=0.1, right=0.95, bottom=0.1, top=0.9, wspace=0.4, hspace=0.3)
-
-        # Plot fuzzy risk set
-        labels = []
-        for i, label in enumerate(self.fuzzyRisks):
-            ax.plot(self.fuzzyRisks[label].x, self.fuzzyRisks[label].y, f':{self.LINE_COLORS[i]}', label=self.fuzzyRisks[label].label, linewidth=1)
-            labels.append(label)
-
-        # Plot aggregation
-        ax.plot(aggregation[0], aggregation[1], '-b', label='Aggregation')
-        labels.append('Aggregation')
-        
-        # Plot defuzz value
-        ax.plot([defuzz, defuzz], [0, 1], 'r', label='Defuzzification', linewidth=1, linestyle='--')
-        labels.append(self.options["defuzz_mode"])
-        ax.set_xlabel("Risk")
-        ax.set_ylabel("Membership degree")
-        ax.legend(labels, loc='lower right', fontsize='xx-small')
+        import matplotlib.pyplot as plt
+        plots.draw_fuzzysets(plt.figure(figsize=(12, 5)), self._plotted_sets())
+
+    def _plotted_sets(self) -> list[tuple]:
+        # (var, label, x, y) of every fuzzy set, risks included
+        return [(fuzzySet.var, fuzzySet.label, fuzzySet.x, fuzzySet.y) for fuzzySet in self.fuzzySets.values()]
+
+    def _plot_aggregation(self, appId: str, aggregation, defuzz: int) -> None:
+        import matplotlib.pyplot as plt
+        riskSets = [(label, fuzzySet.x, fuzzySet.y) for label, fuzzySet in self.fuzzyRisks.items()]
+        plots.draw_aggregation(plt.figure(), appId, riskSets, aggregation[0], aggregation[1],
+                               defuzz, self.options["defuzz_mode"])
 
 
     def render(self) -> None:
-        plt.show()
+        # Shows the figures drawn so far, if any: without plots matplotlib is
+        # not even imported, so headless runs never block here
+        if "matplotlib.pyplot" not in sys.modules:
+            return
+        import matplotlib.pyplot as plt
+        if plt.get_fignums():
+            plt.show()
 
     def redraw(self) -> None:
+        import matplotlib.pyplot as plt
         plt.draw()
 
 
@@ -238,13 +911,13 @@ class FuzzySystem:
         # Print fuzzy sets
         if self.options["debug"]["fuzzySets"]:
             print("_____________ Fuzzy Sets ______________\n")
-            fuzzyRisks.printFuzzySetsDict()
-            fuzzyVars.printFuzzySetsDict()
+            self.fuzzyRisks.printFuzzySetsDict()
+            self.fuzzyVars.printFuzzySetsDict()
             
         # Print rules
         if self.options["debug"]["rules"]:
             print("_____________ Rules ______________\n")
-            rules.printRuleList()
+            self.rules.printRuleList()
 
         # Plot fuzzy sets
         if self.options["debug"]["plot"]:
@@ -256,27 +929,95 @@ def write_output(filename):
     
     pass                 
 
-if __name__ == '__main__':
-    fuzzyRisks = loader.readFuzzySetsFile('Risks.txt')
-    fuzzyVars = loader.readFuzzySetsFile('InputVarSets.txt')
-    rules = loader.readRulesFile('Rules.txt')
-    applications: list = loader.readApplicationsFile('Applications.txt')
-    
-    fuzzySystem = FuzzySystem(fuzzyRisks, fuzzyVars, rules, options={
-        "consequents_mode": "S",
-        "defuzz_mode": "som",
-        "debug" : {
+# Process pool workers ______________________________________________
+
+_worker_system: FuzzySystem = None
+
+def _init_worker(fuzzyRisks, fuzzyVars, rules, options, compiled=None) -> None:
+    # compiled: the model of the parent, so the workers do not compile it again
+    global _worker_system
+    _worker_system = FuzzySystem(fuzzyRisks, fuzzyVars, rules, options, compiled)
+
+def _score_chunk(source: tuple, configurations: list[tuple] = None, plot: list[str] = (), binary: bool = False):
+    # Reads (see FuzzySystem._chunk_inputs), scores and formats one chunk.
+    # Returns the formatted results and their number, rules_applied, the
+    # stages measured (metrics on), merged into the ones of the parent, and
+    # the aggregations of the rows plotted
+    system = _worker_system
+    rules_applied = [0] * len(system.rules)
+    if system.metrics is not None and source[0] in ('text', 'binary'):
+        with system.metrics.timer("parsing"):
+            appIds, matrix = system._chunk_inputs(source)
+    else:
+        appIds, matrix = system._chunk_inputs(source)
+    risks, plotted = system._score_arrays(appIds, matrix, configurations, plot, rules_applied)
+    formatted = system._format_results(appIds, risks, binary)
+    stages = system.metrics.drain() if system.metrics is not None else None
+    return formatted, len(appIds), rules_applied, stages, plotted
+
+# Command line ______________________________________________
+
+def cli(arguments: list[str] = None) -> int:
+    # python main.py [--input Applications.txt] [--output Results.txt] [--workers 4] ...
+    parser = argparse.ArgumentParser(description="Scores credit applications with the fuzzy inference system")
+    parser.add_argument("--input", default="Applications.txt", help="applications, text or binary (.bin)")
+    parser.add_argument("--output", default="Results.txt", help="results, text or binary (.bin)")
+    parser.add_argument("--risks", default="Risks.txt")
+    parser.add_argument("--sets", default="InputVarSets.txt")
+    parser.add_argument("--rules", default="Rules.txt")
+    parser.add_argument("--snapshot", help="compiled model snapshot, rebuilt if the text files changed")
+    parser.add_argument("--consequents", default="S", help="C (clip), S (scale) or sugeno")
+    parser.add_argument("--defuzz", default="som", help="centroid, bisector, mom, som or lom")
+    parser.add_argument("--engine", default="sampled", choices=["sampled", "analytic"])
+    parser.add_argument("--membership", default="table", choices=["table", "parametric"])
+    parser.add_argument("--rule-index", action="store_true", help="only evaluate the rules that can fire")
+    parser.add_argument("--all-configurations", action="store_true",
+                        help="one column per consequents/defuzzification configuration")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    parser.add_argument("--plot", default="", help="appIds to plot, comma separated (opens matplotlib)")
+    parser.add_argument("--plot-dir", help="write the plots to this directory instead of showing them")
+    parser.add_argument("--plot-format", default="png", choices=["png", "svg"])
+    parser.add_argument("--plot-workers", type=int, default=2, help="processes drawing the exported plots")
+    parser.add_argument("--metrics", help="file for the metrics, Prometheus text if it ends in .prom, JSON otherwise")
+    parser.add_argument("--rules-applied", action="store_true", help="print the rules applied")
+    args = parser.parse_args(arguments)
+
+    options = {
+        "consequents_mode": args.consequents,
+        "defuzz_mode": args.defuzz,
+        "defuzz_engine": args.engine,
+        "membership_mode": args.membership,
+        "rule_index": args.rule_index,
+        "metrics": bool(args.metrics),
+        "debug": {
             'fuzzySets': False,
             'rules': False,
             'plot': False,
-            'rules_applied': True
+            'rules_applied': args.rules_applied
         }
-    })
-    fuzzySystem.debug()
-
-    # applications_to_plot = ["0020", "0034"]
-    applications_to_plot = ["0051", "0052"]
-    # applications_to_plot = []
-    fuzzySystem.process(applications, plot=applications_to_plot, filename="Results.txt")
+    }
+    fuzzySystem = FuzzySystem.from_files(args.risks, args.sets, args.rules, options, args.snapshot)
+    plot = [appId for appId in args.plot.split(',') if appId]
+
+    exporter = None
+    if args.plot_dir:
+        exporter = fuzzySystem.plot_exporter(args.plot_dir, args.plot_format, args.plot_workers)
+
+    # the plotted applications are drawn (or exported) as their chunk is scored
+    fuzzySystem.process_file(args.input, args.output, args.workers, args.chunk_size,
+                             binary=args.output.endswith('.bin'),
+                             configurations=CONFIGURATIONS if args.all_configurations else None,
+                             plot=plot, exporter=exporter)
+    if args.rules_applied:
+        print("Rules applied", len(fuzzySystem.rules_applied) - fuzzySystem.rules_applied.count(0))
+
+    if exporter is not None:
+        exporter.close()
+    if args.metrics:
+        with open(args.metrics, "w") as file:
+            file.write(fuzzySystem.export_metrics('prometheus' if args.metrics.endswith('.prom') else 'json'))
+    return 0
 
-    
\ No newline at end of file
+if __name__ == '__main__':
+    sys.exit(cli())